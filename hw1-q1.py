@@ -3,66 +3,359 @@
 # Deep Learning Homework 1
 
 import argparse
+import contextlib
+import os
 
 import numpy as np
 import matplotlib.pyplot as plt
 
 import time
+import checkpointing
+import instrumentation
 import utils
 
+# rows scored per block by predict / evaluate
+EVAL_CHUNK_SIZE = 1024
+
+
+def _class_buffers(batch_size, n_classes):
+    """
+    Scratch buffers and views for the (batch_size x n_classes) scores of a
+    training step, shared by the linear models and the MLP.
+    """
+    scores = np.empty((batch_size, n_classes))
+    running_max = np.empty((n_classes, batch_size))
+    ws = {
+        "scores": scores,
+        "targets": np.empty((batch_size, n_classes)),
+        "mask": np.empty((batch_size, n_classes), dtype=bool),
+        "labels": np.empty((batch_size, 1)),
+        "label_grid": np.empty((batch_size, n_classes)),
+        "classes": np.tile(np.arange(n_classes, dtype=float), (batch_size, 1)),
+        "ones_row": np.ones((1, n_classes)),
+        "ones_col": np.ones((n_classes, 1)),
+        "ones_batch": np.ones((1, batch_size)),
+        "expanded": np.empty((batch_size, n_classes)),
+        "running_max": tuple(running_max),
+        "row_max": running_max[-1].reshape(-1, 1),
+        "row_sums": np.empty((batch_size, 1)),
+        "log_sums": np.empty((batch_size, 1)),
+        "gold": np.empty((1, 1)),
+        "log_sum": np.empty((1, 1)),
+        "loss": np.empty((1, 1)),
+        "scores_T": scores.T,
+        # one view per class: its scores for every row of the block
+        "scores_cols": tuple(scores.T),
+    }
+    ws["labels_flat"] = ws["labels"].reshape(-1)
+    ws["targets_flat"] = ws["targets"].reshape(-1)
+    ws["targets_row"] = ws["targets"].reshape(1, -1)
+    ws["scores_flat"] = scores.reshape(-1)
+    ws["scores_col"] = scores.reshape(-1, 1)
+    return ws
+
+
+def _one_hot(ws, y_b):
+    """
+    Write the gold labels y_b (batch_size) into ws["targets"] as a 0/1
+    matrix: the labels repeated along each row, compared with the class
+    indices.
+    """
+    np.copyto(ws["labels_flat"], y_b)
+    label_grid = np.dot(ws["labels"], ws["ones_row"], out=ws["label_grid"])
+    np.equal(label_grid, ws["classes"], out=ws["mask"])
+    np.copyto(ws["targets"], ws["mask"])
+
+
+def _softmax_cross_entropy(ws):
+    """
+    Turn ws["scores"] into softmax(scores) - targets, in place: the gradient
+    of the summed cross-entropy against ws["targets"], whose value is
+    returned in a (1 x 1) buffer. NumPy reductions allocate at every call,
+    so the row maxima are a running maximum over the class columns and the
+    sums are products with ones.
+    """
+    z = ws["scores"]
+    columns, running_max = ws["scores_cols"], ws["running_max"]
+    np.copyto(running_max[0], columns[0])
+    # while rather than for, whose iterator is an allocation
+    k = 1
+    while k < len(columns):
+        np.maximum(running_max[k - 1], columns[k], out=running_max[k])
+        k += 1
+
+    # shifted by the row max for numerical stability
+    expanded = np.dot(ws["row_max"], ws["ones_row"], out=ws["expanded"])
+    np.subtract(z, expanded, out=z)
+    gold = np.dot(ws["targets_row"], ws["scores_col"], out=ws["gold"])
+
+    np.exp(z, out=z)
+    row_sums = np.dot(z, ws["ones_col"], out=ws["row_sums"])
+    log_sums = np.log(row_sums, out=ws["log_sums"])
+    log_sum = np.dot(ws["ones_batch"], log_sums, out=ws["log_sum"])
+    loss = np.subtract(log_sum, gold, out=ws["loss"])
+
+    np.divide(z, np.dot(row_sums, ws["ones_row"], out=expanded), out=z)
+    np.subtract(z, ws["targets"], out=z)
+    return loss
+
 
 class LinearModel(object):
     def __init__(self, n_classes, n_features, **kwargs):
         self.W = np.zeros((n_classes, n_features))
+        self._workspaces = {}
+
+    def _workspace(self, batch_size):
+        """
+        Scratch buffers for an update on batch_size rows. They are allocated
+        the first time a block of that size is seen and reused by every later
+        step, so the training loop itself does not allocate.
+        """
+        ws = self._workspaces.get(batch_size)
+        if ws is None:
+            n_classes, n_features = self.W.shape
+            ws = _class_buffers(batch_size, n_classes)
+            ws.update({
+                "x_row": np.empty((1, n_features)),
+                "grad": np.empty((n_classes, n_features)),
+                "W_T": self.W.T,
+                "step_size": np.empty(()),
+                "decay": np.empty(()),
+            })
+            ws["x_flat"] = ws["x_row"].reshape(-1)
+            self._workspaces[batch_size] = ws
+        return ws
+
+    def state_dict(self):
+        """The weights, as saved in a checkpoint."""
+        return {"W": self.W}
+
+    def load_state_dict(self, state):
+        """Copy saved weights in place: the workspaces hold views of them."""
+        for name, value in state.items():
+            np.copyto(getattr(self, name), value)
 
     def update_weight(self, x_i, y_i, **kwargs):
         raise NotImplementedError
 
-    def train_epoch(self, X, y, **kwargs):
-        for x_i, y_i in zip(X, y):
+    def update_batch(self, X_b, y_b, **kwargs):
+        """
+        X_b (batch_size x n_features): a block of training examples
+        y_b (batch_size): the gold labels for that block
+
+        Fallback for models without a vectorized update: plain per-example
+        SGD over the rows of the block.
+        """
+        for x_i, y_i in zip(X_b, y_b):
             self.update_weight(x_i, y_i, **kwargs)
 
-    def predict(self, X):
-        """X (n_examples x n_features)"""
-        scores = np.dot(self.W, X.T)  # (n_classes x n_examples)
-        predicted_labels = scores.argmax(axis=0)  # (n_examples)
+    def train_epoch(self, X, y, learning_rate=0.001, l2_penalty=0.0, batch_size=1,
+                    alloc_stats=None):
+        """
+        batch_size (int): number of rows per update. batch_size=1 is the
+        original per-example SGD; larger values call update_batch once per
+        block of rows.
+        alloc_stats (dict): stats of a utils.track_allocations block, in
+        which the allocations of every update are counted
+        """
+        # the hyperparameters are passed by position: keyword arguments
+        # forwarded through **kwargs build a dict at every step
+        update_weight, update_batch = self.update_weight, self.update_batch
+        if alloc_stats is not None:
+            update_weight = utils.traced_step(update_weight, alloc_stats)
+            update_batch = utils.traced_step(update_batch, alloc_stats)
+        if batch_size == 1:
+            for x_i, y_i in zip(X, y):
+                update_weight(x_i, y_i, learning_rate, l2_penalty)
+            return
+        for start in range(0, X.shape[0], batch_size):
+            end = start + batch_size
+            update_batch(X[start:end], y[start:end], learning_rate, l2_penalty)
+
+    def _prediction_weights(self):
+        return self.W
+
+    def predict(self, X, chunk_size=EVAL_CHUNK_SIZE):
+        """
+        X (n_examples x n_features)
+        chunk_size (int): rows scored at a time, so the score matrix never
+        holds more than (chunk_size x n_classes) values
+        """
+        W = self._prediction_weights()
+        predicted_labels = np.empty(X.shape[0], dtype=np.int64)  # (n_examples)
+        for start in range(0, X.shape[0], chunk_size):
+            end = start + chunk_size
+            scores = X[start:end] @ W.T  # (chunk_size x n_classes)
+            predicted_labels[start:end] = scores.argmax(axis=1)
         return predicted_labels
 
-    def evaluate(self, X, y):
+    def evaluate(self, X, y, chunk_size=EVAL_CHUNK_SIZE):
         """
         X (n_examples x n_features)
         y (n_examples): gold labels
         """
-        y_hat = self.predict(X)
-        n_correct = (y == y_hat).sum()
-        n_possible = y.shape[0]
-        return n_correct / n_possible
+        W = self._prediction_weights()
+        acc, _ = utils.chunked_evaluate(lambda X_chunk: X_chunk @ W.T, X, y, chunk_size)
+        return acc
 
 
 class Perceptron(LinearModel):
-    def update_weight(self, x_i, y_i, **kwargs):
+    def _workspace(self, batch_size):
+        """
+        The buffers of LinearModel, plus the predicted 0/1 matrix, constants
+        and views used by the mistake-driven update. Views are made once
+        here: creating one is an allocation as well.
+        """
+        ws = self._workspaces.get(batch_size)
+        if ws is None:
+            ws = super()._workspace(batch_size)
+            n_classes, n_features = self.W.shape
+            ws.update({
+                "predicted": np.empty((batch_size, n_classes)),
+                "one": np.ones(()),
+                "count": np.full((1, 1), float(batch_size)),
+                "class_mistakes": np.empty((1, n_classes)),
+                "delta": np.empty(n_features),
+                # one view per class: its row of W
+                "W_rows": tuple(self.W),
+            })
+        return ws
+
+    def update_weight(self, x_i, y_i, *args, **kwargs):
         """
         x_i (n_features): a single training example
         y_i (scalar): the gold label for that example
         other arguments are ignored
         """
-        #initialize true value vector
-        y = np.ones(6,)*(-1)
-        y[y_i] = 1
-        print('y:', y)
+        ws = self._workspace(1)
+
+        #initialize true value vector (1 for the gold class, 0 elsewhere)
+        y = ws["targets_flat"]
+        y.fill(0)
+        y[int(y_i)] = 1
 
         #calculating score z
-        z = self.W @ x_i  
-
-        #getting prediction vector y_hat by applying sign(z)
-        y_hat = np.where(z >= 0, 1, -1)
-        # 3. If (prediction) y_hat[j] != y[j] (true value), update w[j]
-        for j in range(len(y_hat)):
-                if y_hat[j] != y[j]:
-                    self.W[j] = self.W[j] + (y[j] * x_i)
-        
+        np.dot(self.W, x_i, out=ws["scores_flat"])
+
+        np.copyto(ws["x_flat"], x_i)
+        self._correct(ws, ws["x_row"])
+
         #raise NotImplementedError # Q1.1 (a)
 
+    def update_batch(self, X_b, y_b, *args, **kwargs):
+        """
+        X_b (batch_size x n_features): a block of training examples
+        y_b (batch_size): the gold labels for that block
+
+        Same rule as update_weight, with the mistakes of every row found from
+        a single score matrix. The corrections are summed per class and only
+        the rows of W that were mistaken at least once are touched.
+        """
+        # len() rather than .shape, which builds a new tuple
+        ws = self._workspace(len(X_b))
+
+        # gold classes as a 0/1 matrix
+        _one_hot(ws, y_b)
+
+        np.dot(X_b, ws["W_T"], out=ws["scores"])  # (batch_size x n_classes)
+        self._correct(ws, X_b)
+
+    def _correct(self, ws, X_b):
+        """
+        Update W from the scores and the 0/1 gold targets of the rows X_b,
+        already in ws. gold - predicted is +1 / -1 exactly on the mistaken
+        (row, class) pairs and 0 elsewhere, i.e. the y * x correction of the
+        perceptron.
+        """
+        # 1 where sign(z) is +1
+        predicted = np.heaviside(ws["scores"], ws["one"], out=ws["predicted"])
+        corrections = np.subtract(ws["targets"], predicted, out=ws["scores"])
+        # mistakes per class: the column sums of |corrections|
+        np.absolute(corrections, out=predicted)
+        mistakes = np.dot(ws["ones_batch"], predicted, out=ws["class_mistakes"])
+
+        # only the classes with a mistake are updated, through their row
+        # views: W[rows] += delta would allocate index structures at every
+        # step, and so would the iterator of a for loop
+        # the scores buffer now holds the corrections
+        corrections_rows = ws["scores_cols"]
+        k = 0
+        while k < len(corrections_rows):
+            if mistakes.item(k):
+                delta = np.dot(corrections_rows[k], X_b, out=ws["delta"])
+                self._apply_update(ws, k, delta)
+            k += 1
+
+    def _apply_update(self, ws, k, delta):
+        """
+        k (int): the class whose weights change
+        delta (n_features): the correction for that class, in a scratch
+        buffer that may be overwritten
+        """
+        W_k = ws["W_rows"][k]
+        np.add(W_k, delta, out=W_k)
+
+
+class AveragedPerceptron(Perceptron):
+    """
+    Perceptron that predicts with the average of its weights over all
+    training examples. The average is kept lazily: an update made after c
+    examples is also accumulated as c * delta in U, and the averaged weights
+    are W - U / c, so a step costs O(changed rows) instead of O(W).
+    """
+    def __init__(self, n_classes, n_features, **kwargs):
+        super().__init__(n_classes, n_features, **kwargs)
+        self.U = np.zeros((n_classes, n_features))
+        # c is a (1 x 1) matrix so that it scales through BLAS; a ufunc
+        # writing a single element over its own input allocates, hence the
+        # second buffer to count into
+        self.c = np.zeros((1, 1))
+        self._c_next = np.zeros((1, 1))
+
+    def _workspace(self, batch_size):
+        """
+        The Perceptron buffers, plus the rows of U, a column view of the
+        correction and a buffer for its scaled copy.
+        """
+        ws = self._workspaces.get(batch_size)
+        if ws is None:
+            ws = super()._workspace(batch_size)
+            ws["U_rows"] = tuple(self.U)
+            ws["delta_col"] = ws["delta"].reshape(-1, 1)
+            ws["scaled_col"] = np.empty_like(ws["delta_col"])
+            ws["scaled"] = ws["scaled_col"].reshape(-1)
+        return ws
+
+    def update_weight(self, x_i, y_i, *args, **kwargs):
+        # not super(): creating the super object would allocate at every step
+        Perceptron.update_weight(self, x_i, y_i)
+        self._count(self._workspace(1))
+
+    def update_batch(self, X_b, y_b, *args, **kwargs):
+        Perceptron.update_batch(self, X_b, y_b)
+        self._count(self._workspace(len(X_b)))
+
+    def _count(self, ws):
+        np.add(self.c, ws["count"], out=self._c_next)
+        np.copyto(self.c, self._c_next)
+
+    def _apply_update(self, ws, k, delta):
+        W_k, U_k = ws["W_rows"][k], ws["U_rows"][k]
+        np.add(W_k, delta, out=W_k)
+        np.dot(ws["delta_col"], self.c, out=ws["scaled_col"])
+        np.add(U_k, ws["scaled"], out=U_k)
+
+    def state_dict(self):
+        return {"W": self.W, "U": self.U, "c": self.c}
+
+    def averaged_weights(self):
+        if self.c == 0:
+            return self.W.copy()
+        return self.W - self.U / self.c
+
+    def _prediction_weights(self):
+        return self.averaged_weights()
+
 
 class LogisticRegression(LinearModel):
     def update_weight(self, x_i, y_i, learning_rate=0.001, l2_penalty=0.0, **kwargs):
@@ -71,29 +364,71 @@ class LogisticRegression(LinearModel):
         y_i: the gold label for that example
         learning_rate (float): keep it at the default value for your plots
         """
-        # calculating score z
-        z = self.W @ x_i
+        ws = self._workspace(1)
 
-        # calucalting softmax 
-        P = np.exp(z)/np.sum(np.exp(z))
+        # calculating score z
+        np.dot(self.W, x_i, out=ws["scores_flat"])
 
-        # correct class
-        y = np.zeros(6)
-        y[y_i] = 1
-        
-        # gradient of loss function
-        loss_grad = np.outer((P - y), x_i)
+        # y, the one-hot vector of the correct class
+        y = ws["targets_flat"]
+        y.fill(0)
+        y[int(y_i)] = 1
 
-        # weight updatea
-        self.W = self.W - learning_rate * (loss_grad + l2_penalty * self.W)
+        np.copyto(ws["x_flat"], x_i)
+        self._step(ws, ws["x_row"], learning_rate, l2_penalty)
 
        #raise NotImplementedError # Q1.2 (a,b)
 
+    def update_batch(self, X_b, y_b, learning_rate=0.001, l2_penalty=0.0, **kwargs):
+        """
+        X_b (batch_size x n_features): a block of training examples
+        y_b (batch_size): the gold labels for that block
+        learning_rate (float): keep it at the default value for your plots
+
+        Mini-batch SGD step on the mean loss of the block. With a single row
+        this is the same step as update_weight.
+        """
+        ws = self._workspace(len(X_b))
+        np.dot(X_b, ws["W_T"], out=ws["scores"])  # (batch_size x n_classes)
+        _one_hot(ws, y_b)
+        self._step(ws, X_b, learning_rate, l2_penalty)
+
+    def _step(self, ws, X_b, learning_rate, l2_penalty):
+        """
+        SGD step on the mean loss of the rows X_b, from their scores and
+        one-hot targets already in ws.
+        """
+        # P - y, with P the softmax of each row of scores
+        _softmax_cross_entropy(ws)
+
+        # gradient of loss function
+        loss_grad = np.dot(ws["scores_T"], X_b, out=ws["grad"])
+
+        # weight update, in place: W <- (1 - lr * l2) * W - lr * mean grad
+        if l2_penalty:
+            decay = ws["decay"]
+            decay.fill(1 - learning_rate * l2_penalty)
+            np.multiply(self.W, decay, out=self.W)
+        step_size = ws["step_size"]
+        step_size.fill(learning_rate / len(X_b))
+        np.multiply(loss_grad, step_size, out=loss_grad)
+        np.subtract(self.W, loss_grad, out=self.W)
+
 
 class MLP(object):
     def __init__(self, n_classes, n_features, hidden_size):
         self.W1 = np.append(np.random.normal(loc=0.1, scale=0.1, size=(hidden_size, n_features)), np.zeros((hidden_size, 1)), axis=1)
         self.W2 = np.append(np.random.normal(loc=0.1, scale=0.1, size=(n_classes, hidden_size)), np.zeros((n_classes, 1)), axis=1)
+        self._workspaces = {}
+
+    def state_dict(self):
+        """The weights, as saved in a checkpoint."""
+        return {"W1": self.W1, "W2": self.W2}
+
+    def load_state_dict(self, state):
+        """Copy saved weights in place: the workspaces hold views of them."""
+        for name, value in state.items():
+            np.copyto(getattr(self, name), value)
     
     def fprop(self, X):
         # Compute the forward pass of the network. At prediction time, there is
@@ -115,71 +450,131 @@ class MLP(object):
 
         return (X_b, z1, h, z2)
     
-    def predict(self, X):
+    def predict(self, X, chunk_size=EVAL_CHUNK_SIZE):
         # Compute the forward pass of the network. At prediction time, there is
         # no need to save the values of hidden nodes.
-        _, _, _, z2 = self.fprop(X)
-        
-        predicted_labels = np.zeros((z2.shape[1],))
-        for i in range(z2.shape[1]):
-            row = z2.T[i]
-            softmax = np.exp(row - max(row))/np.sum(np.exp(row - max(row)))
-            predicted_labels[i] = softmax.argmax()
-        
+        # The softmax is monotonic, so the argmax of the scores z2 is already
+        # the predicted class; rows are pushed through fprop chunk_size at a
+        # time to bound the size of the hidden activations.
+        predicted_labels = np.empty(X.shape[0], dtype=np.int64)
+        for start in range(0, X.shape[0], chunk_size):
+            end = start + chunk_size
+            _, _, _, z2 = self.fprop(X[start:end])  # (n_classes x chunk_size)
+            predicted_labels[start:end] = z2.argmax(axis=0)
+
         return predicted_labels
 
-    def evaluate(self, X, y):
+    def evaluate(self, X, y, chunk_size=EVAL_CHUNK_SIZE):
         """
         X (n_examples x n_features)
         y (n_examples): gold labels
         """
-        # Identical to LinearModel.evaluate()
-        y_hat = self.predict(X)
-        print("y_hat & y shapes: ", y_hat.shape, " , ", y.shape)
-        n_correct = (y == y_hat).sum()
-        n_possible = y.shape[0]
-        return n_correct / n_possible
+        # z2 is (n_classes x chunk_size)
+        acc, _ = utils.chunked_evaluate(lambda X_chunk: self.fprop(X_chunk)[3].T, X, y, chunk_size)
+        return acc
 
-    def train_epoch(self, X, y, learning_rate=0.001, **kwargs):
+    def _workspace(self, batch_size):
+        """
+        Scratch buffers for a training step on batch_size rows: the augmented
+        input (bias column fixed to 1), activations (bias row fixed to 1),
+        scores and gradients. Allocated once per block size and reused.
+        """
+        ws = self._workspaces.get(batch_size)
+        if ws is None:
+            hidden_size, n_in = self.W1.shape
+            n_classes = self.W2.shape[0]
+            X_b = np.ones((batch_size, n_in))
+            h = np.ones((hidden_size + 1, batch_size))
+            h_grad = np.empty((hidden_size + 1, batch_size))
+            ws = _class_buffers(batch_size, n_classes)
+            ws.update({
+                "X_b": X_b,
+                "z1": np.empty((hidden_size, batch_size)),
+                "relu_grad": np.empty((hidden_size, batch_size)),
+                "h": h,
+                "h_grad": h_grad,
+                "W1_grad": np.empty_like(self.W1),
+                "W2_grad": np.empty_like(self.W2),
+                "zero": np.zeros(()),
+                "batch_size": np.array(float(batch_size)),
+                "learning_rate": np.empty(()),
+                # views, made once: creating one is an allocation as well
+                "X_in": X_b[:, :-1],
+                "X_b_T": X_b.T,
+                "h_hidden": h[:-1],
+                "h_T": h.T,
+                "h_grad_hidden": h_grad[:-1],
+                "W2_T": self.W2.T,
+            })
+            self._workspaces[batch_size] = ws
+        return ws
+
+    def train_batch(self, X, y, learning_rate=0.001):
+        """
+        X (batch_size x n_features): a block of training examples
+        y (batch_size): gold labels
+        Runs one forward/backward pass over the whole block and updates W1 and
+        W2 once, in place, with the gradient of the mean loss. Returns the
+        summed cross-entropy of the block (before the update).
+        """
+        ws = self._workspace(len(X))
+
+        # same computation as fprop, written into the preallocated buffers
+        X_b = ws["X_b"]
+        np.copyto(ws["X_in"], X)
+        z1 = np.dot(self.W1, ws["X_b_T"], out=ws["z1"])
+        h = ws["h"]
+        np.maximum(z1, ws["zero"], out=ws["h_hidden"])
+        # the scores are (batch_size x n_classes), the layout of the shared
+        # softmax buffers
+        np.dot(ws["h_T"], ws["W2_T"], out=ws["scores"])
+
+        # softmax - one-hot, and the loss of the block
+        _one_hot(ws, y)
+        Loss = _softmax_cross_entropy(ws).item()
+
+        # averaged over the block
+        L_grad_T = ws["scores_T"]  # (n_classes x batch_size)
+        np.divide(L_grad_T, ws["batch_size"], out=L_grad_T)
+
+        W2_grad = np.dot(L_grad_T, ws["h_T"], out=ws["W2_grad"])
+        np.dot(ws["W2_T"], L_grad_T, out=ws["h_grad"])
+
+        #derivative of relu when z>0 = 1, else 0
+        z1_grad = ws["h_grad_hidden"]
+        np.multiply(z1_grad, np.heaviside(z1, ws["zero"], out=ws["relu_grad"]), out=z1_grad)
+
+        W1_grad = np.dot(z1_grad, X_b, out=ws["W1_grad"])
+
+        #updates (with biases inside weight vectors)
+        lr = ws["learning_rate"]
+        lr.fill(learning_rate)
+        np.multiply(W1_grad, lr, out=W1_grad)
+        np.subtract(self.W1, W1_grad, out=self.W1)
+        np.multiply(W2_grad, lr, out=W2_grad)
+        np.subtract(self.W2, W2_grad, out=self.W2)
+        return Loss
+
+    def train_epoch(self, X, y, learning_rate=0.001, batch_size=1, alloc_stats=None, **kwargs):
         """
         Dont forget to return the loss of the epoch.
+        batch_size (int): number of rows per update; 1 is per-example SGD.
+        alloc_stats (dict): stats of a utils.track_allocations block, in
+        which the allocations of every step are counted
         """
+        train_batch = self.train_batch
+        if alloc_stats is not None:
+            train_batch = utils.traced_step(train_batch, alloc_stats)
         #Stochastic gradient loss
         #random_indices = np.random.choice(X.shape[0], size=1, replace=False)
         #random_rows = X[random_indices]
         Loss = 0
 
-        for i in range(X.shape[0]):
-            image = X[i].reshape((X.shape[1],1)).T
-            #image = image
-            X_b, z1, h, z2 = self.fprop(image)
-            #if i < 1 : print("\nX_b shape: ", X_b.shape, "\nz1 shape: ", z1.shape, "\nh shape:", h.shape, "\nz2 shape:", z2.shape)
-            
-            #normalize z2 scores:
-            z2 = z2 - max(z2)
-            z_sum = np.sum(np.exp(z2))
-
-            y_true = np.zeros((6, 1))
-            y_true[y[i]] = 1
-            
-            Loss += (y_true.T @ (z2) + np.log(z_sum))[0][0]
-
-            L_grad = (np.exp(z2)/z_sum) - y_true
-
-            W2_grad = L_grad @ h.T
-            h_grad = (self.W2.T @ L_grad)            
-            
-            #derivative of relu when z>0 = 1, else 0
-            z1_grad = h_grad[:-1] * np.where(z1>0, 1, 0)
-
-            W1_grad = z1_grad @ X_b
-
-            #updates (with biases inside weight vectors)
-            self.W1 = self.W1 - learning_rate * W1_grad
-            self.W2 = self.W2 - learning_rate * W2_grad
- 
+        for start in range(0, X.shape[0], batch_size):
+            end = start + batch_size
+            Loss += train_batch(X[start:end], y[start:end], learning_rate)
+
         L_epoch = Loss/X.shape[0]
-        print("denominator: ", X.shape[0] )
         print("Loss: ", L_epoch)
         return L_epoch
         #raise NotImplementedError # Q1.3 (a)
@@ -218,7 +613,8 @@ def plot_w_norm(epochs, w_norms, filename=None):
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('model',
-                        choices=['perceptron', 'logistic_regression', 'mlp'],
+                        choices=['perceptron', 'averaged_perceptron',
+                                 'logistic_regression', 'mlp'],
                         help="Which model should the script run?")
     parser.add_argument('-epochs', default=20, type=int,
                         help="""Number of epochs to train for. You should not
@@ -230,13 +626,37 @@ def main():
                         help="""Learning rate for parameter updates (needed for
                         logistic regression and MLP, but not perceptron)""")
     parser.add_argument('-l2_penalty', type=float, default=0.0,)
+    parser.add_argument('-batch_size', type=int, default=1,
+                        help="""Number of examples per weight update. 1 is plain
+                        per-example SGD.""")
     parser.add_argument('-data_path', type=str, default='intel_landscapes.npz',)
+    parser.add_argument('-lazy_data', action='store_true',
+                        help="""Memory-map a uint8 cache of the dataset and
+                        normalize examples only when a block is used.""")
+    parser.add_argument('-dtype', choices=['float64', 'float32'], default='float64',
+                        help="Floating point type of the normalized inputs.")
+    parser.add_argument('-eval_chunk_size', type=int, default=EVAL_CHUNK_SIZE,
+                        help="""Number of examples scored at a time when
+                        computing accuracies.""")
+    parser.add_argument('-trace_allocs', action='store_true',
+                        help="""Report the heap memory allocated by each training
+                        epoch and how many of its update steps allocated.""")
+    parser.add_argument('-checkpoint', type=str, default=None,
+                        help="""Checkpoint file (default: named after the
+                        model, like the plots).""")
+    parser.add_argument('-checkpoint_every', type=int, default=1,
+                        help="""Save a checkpoint every this many epochs, on a
+                        background thread (0 to disable).""")
+    parser.add_argument('-resume', action='store_true',
+                        help="""Continue from the checkpoint, if there is one,
+                        exactly as if the run had not been interrupted.""")
     opt = parser.parse_args()
 
     utils.configure_seed(seed=42)
 
     add_bias = opt.model != "mlp"
-    data = utils.load_dataset(data_path=opt.data_path, bias=add_bias)
+    data = utils.load_dataset(
+        data_path=opt.data_path, bias=add_bias, lazy=opt.lazy_data, dtype=opt.dtype)
     train_X, train_y = data["train"]
     dev_X, dev_y = data["dev"]
     test_X, test_y = data["test"]
@@ -246,6 +666,8 @@ def main():
     # initialize the model
     if opt.model == 'perceptron':
         model = Perceptron(n_classes, n_feats)
+    elif opt.model == 'averaged_perceptron':
+        model = AveragedPerceptron(n_classes, n_feats)
     elif opt.model == 'logistic_regression':
         model = LogisticRegression(n_classes, n_feats)
     else:
@@ -256,54 +678,121 @@ def main():
     valid_accs = []
     train_accs = []
 
+    checkpointer = checkpointing.AsyncCheckpointer(
+        opt.checkpoint or f"Q1-{opt.model}-checkpoint.pt")
+    # position of each current training row in the original order
+    order = np.arange(train_X.shape[0])
+    start_epoch = 1
+    if opt.resume and os.path.exists(checkpointer.path):
+        state = checkpointer.load()
+        model.load_state_dict(state['model'])
+        checkpointing.set_rng_state(state['rng'])
+        order = state['order']
+        if opt.lazy_data:
+            train_X = train_X.permute(order)
+        else:
+            train_X = train_X[order]
+        train_y = train_y[order]
+        train_accs = state['history']['train_accs']
+        valid_accs = state['history']['valid_accs']
+        train_loss = state['history']['train_loss']
+        weight_norms = state['history']['weight_norms']
+        start_epoch = state['epoch'] + 1
+        print('Resuming after epoch {} from {}'.format(state['epoch'], checkpointer.path))
+
+    logger = instrumentation.EpochLogger(
+        f"Q1-{opt.model}-timings.jsonl", append=start_epoch > 1, **vars(opt))
+
     start = time.time()
 
-    print('initial train acc: {:.4f} | initial val acc: {:.4f}'.format(
-        model.evaluate(train_X, train_y), model.evaluate(dev_X, dev_y)
-    ))
-    
-    for i in epochs:
-        print('Training epoch {}'.format(i))
-        train_order = np.random.permutation(train_X.shape[0])
-        train_X = train_X[train_order]
-        train_y = train_y[train_order]
-        if opt.model == 'mlp':
-            loss = model.train_epoch(
-                train_X,
-                train_y,
-                learning_rate=opt.learning_rate
-            )
-        else:
-            model.train_epoch(
-                train_X,
-                train_y,
-                learning_rate=opt.learning_rate,
-                l2_penalty=opt.l2_penalty,
-            )
-        
-        train_accs.append(model.evaluate(train_X, train_y))
-        valid_accs.append(model.evaluate(dev_X, dev_y))
-        if opt.model == 'mlp':
-            print('loss: {:.4f} | train acc: {:.4f} | val acc: {:.4f}'.format(
-                loss, train_accs[-1], valid_accs[-1],
-            ))
-            train_loss.append(loss)
-        elif opt.model == "logistic_regression":
-            weight_norm = np.linalg.norm(model.W)
-            print('train acc: {:.4f} | val acc: {:.4f} | W norm: {:.4f}'.format(
-                 train_accs[-1], valid_accs[-1], weight_norm,
-            ))
-            weight_norms.append(weight_norm)
-        else:
-            print('train acc: {:.4f} | val acc: {:.4f}'.format(
-                 train_accs[-1], valid_accs[-1],
-            ))
+    if start_epoch == 1:
+        print('initial train acc: {:.4f} | initial val acc: {:.4f}'.format(
+            model.evaluate(train_X, train_y, chunk_size=opt.eval_chunk_size),
+            model.evaluate(dev_X, dev_y, chunk_size=opt.eval_chunk_size),
+        ))
+
+    try:
+        for i in epochs[start_epoch - 1:]:
+            print('Training epoch {}'.format(i))
+            logger.start_epoch(i)
+            with logger.phase('data'):
+                train_order = np.random.permutation(train_X.shape[0])
+                order = order[train_order]
+                if opt.lazy_data:
+                    train_X = train_X.permute(train_order)
+                else:
+                    train_X = train_X[train_order]
+                train_y = train_y[train_order]
+            allocs = utils.track_allocations() if opt.trace_allocs else contextlib.nullcontext()
+            with allocs as alloc_stats, logger.phase('train'):
+                if opt.model == 'mlp':
+                    loss = model.train_epoch(
+                        train_X,
+                        train_y,
+                        learning_rate=opt.learning_rate,
+                        batch_size=opt.batch_size,
+                        alloc_stats=alloc_stats,
+                    )
+                else:
+                    model.train_epoch(
+                        train_X,
+                        train_y,
+                        learning_rate=opt.learning_rate,
+                        l2_penalty=opt.l2_penalty,
+                        batch_size=opt.batch_size,
+                        alloc_stats=alloc_stats,
+                    )
+            if opt.trace_allocs:
+                print('epoch peak alloc: {} bytes | retained: {} bytes in {} blocks | '
+                      'allocating steps: {} / {}'.format(
+                    alloc_stats["peak_bytes"], alloc_stats["net_bytes"],
+                    alloc_stats["net_blocks"],
+                    alloc_stats["allocating_steps"], alloc_stats["steps"],
+                ))
+            logger.add_examples(train_X.shape[0])
+
+            with logger.phase('evaluation'):
+                train_accs.append(model.evaluate(train_X, train_y, chunk_size=opt.eval_chunk_size))
+                valid_accs.append(model.evaluate(dev_X, dev_y, chunk_size=opt.eval_chunk_size))
+            epoch_metrics = {'train_acc': train_accs[-1], 'val_acc': valid_accs[-1]}
+            if opt.model == 'mlp':
+                epoch_metrics['train_loss'] = loss
+            logger.end_epoch(**epoch_metrics)
+            if opt.model == 'mlp':
+                print('loss: {:.4f} | train acc: {:.4f} | val acc: {:.4f}'.format(
+                    loss, train_accs[-1], valid_accs[-1],
+                ))
+                train_loss.append(loss)
+            elif opt.model == "logistic_regression":
+                weight_norm = np.linalg.norm(model.W)
+                print('train acc: {:.4f} | val acc: {:.4f} | W norm: {:.4f}'.format(
+                     train_accs[-1], valid_accs[-1], weight_norm,
+                ))
+                weight_norms.append(weight_norm)
+            else:
+                print('train acc: {:.4f} | val acc: {:.4f}'.format(
+                     train_accs[-1], valid_accs[-1],
+                ))
+
+            if opt.checkpoint_every > 0 and (i % opt.checkpoint_every == 0 or i == opt.epochs):
+                checkpointer.save({
+                    'epoch': int(i),
+                    'model': model.state_dict(),
+                    'rng': checkpointing.rng_state(),
+                    # each epoch reshuffles the rows from their previous order
+                    'order': order,
+                    'history': {'train_accs': train_accs, 'valid_accs': valid_accs,
+                                'train_loss': train_loss, 'weight_norms': weight_norms},
+                })
+    finally:
+        checkpointer.close()
+        logger.close()
     elapsed_time = time.time() - start
     minutes = int(elapsed_time // 60)
     seconds = int(elapsed_time % 60)
     print('Training took {} minutes and {} seconds'.format(minutes, seconds))
     print('Final test acc: {:.4f}'.format(
-        model.evaluate(test_X, test_y)
+        model.evaluate(test_X, test_y, chunk_size=opt.eval_chunk_size)
         ))
 
     # plot
@@ -313,7 +802,7 @@ def main():
     elif opt.model == 'logistic_regression':
         plot_w_norm(epochs, weight_norms, filename=f"Q1-{opt.model}-w_norms.pdf")
     with open(f"Q1-{opt.model}-results.txt", "w") as f:
-        f.write(f"Final test acc: {model.evaluate(test_X, test_y)}\n")
+        f.write(f"Final test acc: {model.evaluate(test_X, test_y, chunk_size=opt.eval_chunk_size)}\n")
         f.write(f"Training time: {minutes} minutes and {seconds} seconds\n")
 
 
@@ -3,15 +3,23 @@
 # Deep Learning Homework 1
 
 import argparse
+import copy
+import math
+import os
 
 import torch
+from torch.func import stack_module_state
 from torch.utils.data import DataLoader
 import torch.nn as nn
 from matplotlib import pyplot as plt
 
 import time
+import checkpointing
+import instrumentation
 import utils
 
+EVAL_BATCH_SIZE = 1024
+
 
 class LogisticRegression(nn.Module):
 
@@ -108,7 +116,7 @@ class FeedforwardNetwork(nn.Module):
         raise NotImplementedError
 
 
-def train_batch(X, y, model, optimizer, criterion, **kwargs):
+def train_batch(X, y, model, optimizer, criterion, timer=None, **kwargs):
     """
     X (n_examples x n_features)
     y (n_examples): gold labels
@@ -125,17 +133,24 @@ def train_batch(X, y, model, optimizer, criterion, **kwargs):
 
     This function should return the loss (tip: call loss.item()) to get the
     loss as a numerical value that is not part of the computation graph.
+
+    timer: optional instrumentation.EpochLogger that is charged the time of
+    the forward, backward and optimizer phases
     """
-    # clear the gradients
-    optimizer.zero_grad()
-    # compute the model output
-    y_hat  = model(X)
-    # calculate loss
-    loss = criterion(y_hat, y)
-    # compute gradient and assign 
-    loss.backward()
-    # update model weights
-    optimizer.step()
+    phase = timer.phase if timer is not None else instrumentation.no_phase
+    with phase('forward'):
+        # clear the gradients
+        optimizer.zero_grad()
+        # compute the model output
+        y_hat  = model(X)
+        # calculate loss
+        loss = criterion(y_hat, y)
+    with phase('backward'):
+        # compute gradient and assign 
+        loss.backward()
+    with phase('optimizer'):
+        # update model weights
+        optimizer.step()
     #raise NotImplementedError
     return loss.item()
 
@@ -148,31 +163,176 @@ def predict(model, X):
 
 
 @torch.no_grad()
-def evaluate(model, X, y, criterion):
+def evaluate(model, X, y, criterion, batch_size=EVAL_BATCH_SIZE):
     """
     X (n_examples x n_features)
     y (n_examples): gold labels
+    batch_size (int): examples scored at a time (0: all at once)
     """
     model.eval()
-    logits = model(X)
-    loss = criterion(logits, y)
-    loss = loss.item()
-    y_hat = logits.argmax(dim=-1)
-    n_correct = (y == y_hat).sum().item()
-    n_possible = float(y.shape[0])
+    with torch.inference_mode():
+        acc, loss = utils.chunked_evaluate(model, X, y, batch_size, loss_fn=criterion)
     model.train()
-    return loss, n_correct / n_possible
+    return loss, acc
 
 
-def plot(epochs, plottables, filename=None, ylim=None):
+class StackedModels(object):
+    """
+    N models with the same architecture trained together on the same
+    batches. Their parameters are stacked along a leading model dimension,
+    so each layer is one matmul for all the models instead of N small ones:
+    the first layer multiplies the shared input by the weights of every
+    model side by side, later layers are batched (bmm). Every model has its
+    own learning rate and L2 decay; the sgd (with momentum) and adam updates
+    follow torch.optim.SGD and torch.optim.Adam.
+
+    The models must be chains of nn.Linear layers and parameter-free
+    modules (activations, dropout), like LogisticRegression and
+    FeedforwardNetwork.
+    """
+
+    def __init__(self, models, learning_rates, l2_decays, optimizer='sgd', momentum=0.0):
+        """
+        models: list of N nn.Modules with the same architecture
+        learning_rates, l2_decays: N values each
+        """
+        self.n_models = len(models)
+        self.params, _ = stack_module_state(models)
+        # the architecture, for its parameter-free modules (and train/eval mode)
+        self.base = copy.deepcopy(models[0])
+        self.layers = []
+        # FeedforwardNetwork reuses one activation module, so keep duplicates
+        for name, module in self.base.named_modules(remove_duplicate=False):
+            if list(module.children()):
+                continue
+            if not isinstance(module, nn.Linear) and list(module.parameters()):
+                raise ValueError('Cannot stack {}'.format(type(module).__name__))
+            self.layers.append((name, module))
+        self.learning_rates = torch.tensor(learning_rates, dtype=torch.float32)
+        self.l2_decays = torch.tensor(l2_decays, dtype=torch.float32)
+        self.optimizer = optimizer
+        self.momentum = momentum
+        self.state = {name: {} for name in self.params}
+        self.n_steps = 0
+
+    def train(self, mode=True):
+        self.base.train(mode)
+
+    def eval(self):
+        self.base.eval()
+
+    def __call__(self, X):
+        """X (batch_size x n_features) -> logits (n_models x batch_size x n_classes)"""
+        h = X
+        for name, module in self.layers:
+            if not isinstance(module, nn.Linear):
+                # elementwise, so applying it to all the models at once is the same
+                h = module(h)
+                continue
+            W = self.params[name + '.weight']  # (n_models x out x in)
+            b = self.params[name + '.bias']  # (n_models x out)
+            if h.dim() == 2:
+                # shared input: one (batch x in) @ (in x n_models*out) matmul
+                h = torch.addmm(b.reshape(-1), h, W.reshape(-1, W.shape[-1]).t())
+                h = h.view(h.shape[0], self.n_models, -1).transpose(0, 1)
+            else:
+                h = torch.baddbmm(b.unsqueeze(1), h, W.transpose(1, 2))
+        return h
+
+    @torch.no_grad()
+    def step(self):
+        """Update every model with its gradient, then clear the gradients."""
+        self.n_steps += 1
+        for name, param in self.params.items():
+            # per-model hyperparameters, broadcast over the parameter's shape
+            shape = (-1,) + (1,) * (param.dim() - 1)
+            lr = self.learning_rates.view(shape)
+            grad = param.grad + self.l2_decays.view(shape) * param
+            state = self.state[name]
+            if self.optimizer == 'sgd':
+                if self.momentum:
+                    if 'momentum_buffer' not in state:
+                        state['momentum_buffer'] = grad.clone()
+                    else:
+                        state['momentum_buffer'].mul_(self.momentum).add_(grad)
+                    grad = state['momentum_buffer']
+                param.sub_(lr * grad)
+            else:
+                beta1, beta2, eps = 0.9, 0.999, 1e-8
+                if not state:
+                    state['exp_avg'] = torch.zeros_like(param)
+                    state['exp_avg_sq'] = torch.zeros_like(param)
+                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+                exp_avg.lerp_(grad, 1 - beta1)
+                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                bias_correction1 = 1 - beta1 ** self.n_steps
+                bias_correction2 = 1 - beta2 ** self.n_steps
+                denom = (exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(eps)
+                param.sub_(lr / bias_correction1 * exp_avg / denom)
+            param.grad = None
+
+
+def stacked_losses(logits, y):
+    """
+    logits (n_models x n_examples x n_classes)
+    y (n_examples): gold labels
+    Returns the mean cross-entropy of each model (n_models).
+    """
+    n_models = logits.shape[0]
+    losses = nn.functional.cross_entropy(
+        logits.reshape(-1, logits.shape[-1]), y.repeat(n_models), reduction='none')
+    return losses.view(n_models, -1).mean(dim=1)
+
+
+def train_batch_stacked(X, y, models, timer=None):
+    """
+    X (n_examples x n_features)
+    y (n_examples): gold labels
+    models: StackedModels
+    Returns the loss of each model, as a list.
+    """
+    phase = timer.phase if timer is not None else instrumentation.no_phase
+    with phase('forward'):
+        losses = stacked_losses(models(X), y)
+    with phase('backward'):
+        # the models share no parameters, so each gets the gradient of its own loss
+        losses.sum().backward()
+    with phase('optimizer'):
+        models.step()
+    return losses.tolist()
+
+
+@torch.no_grad()
+def evaluate_stacked(models, X, y, batch_size=EVAL_BATCH_SIZE):
+    """
+    X (n_examples x n_features)
+    y (n_examples): gold labels
+    batch_size (int): examples scored at a time (0: all at once)
+    Returns the loss and the accuracy of each model, as lists.
+    """
+    models.eval()
+    with torch.inference_mode():
+        accs, losses = utils.chunked_evaluate(models, X, y, batch_size, loss_fn=stacked_losses)
+    models.train()
+    return losses, accs
+
+
+def plot(epochs, plottables, filename=None, ylim=None, best=None):
     """Plot the plottables over the epochs.
     
-    Plottables is a dictionary mapping labels to lists of values.
+    Plottables is a dictionary mapping labels to lists of values, or to
+    (positions, values) for values not measured once per epoch. best marks
+    the position of the model that was kept.
     """
     plt.clf()
     plt.xlabel('Epoch')
     for label, plottable in plottables.items():
-        plt.plot(epochs, plottable, label=label)
+        if isinstance(plottable, tuple):
+            plt.plot(*plottable, label=label)
+        else:
+            plt.plot(epochs, plottable, label=label)
+    if best is not None:
+        plt.axvline(best, color='gray', linestyle='--', label='Best model')
     plt.legend()
     if ylim:
         plt.ylim(ylim)
@@ -180,7 +340,7 @@ def plot(epochs, plottables, filename=None, ylim=None):
         plt.savefig(filename, bbox_inches='tight')
 
 
-def main():
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('model',
                         choices=['logistic_regression', 'mlp'],
@@ -201,39 +361,101 @@ def main():
     parser.add_argument('-optimizer',
                         choices=['sgd', 'adam'], default='sgd')
     parser.add_argument('-data_path', type=str, default='intel_landscapes.npz',)
-    opt = parser.parse_args()
+    parser.add_argument('-lazy_data', action='store_true',
+                        help="""Memory-map a uint8 cache of the dataset and
+                        normalize examples when they are indexed.""")
+    parser.add_argument('-batch_loader', action='store_true',
+                        help="""Build each training batch with one index-select
+                        instead of a DataLoader (same batches, same seed).""")
+    parser.add_argument('-checkpoint', type=str, default=None,
+                        help="""Checkpoint file (default: named after the
+                        configuration, like the plots).""")
+    parser.add_argument('-checkpoint_every', type=int, default=1,
+                        help="""Save a checkpoint every this many epochs, on a
+                        background thread (0 to disable).""")
+    parser.add_argument('-resume', action='store_true',
+                        help="""Continue from the checkpoint, if there is one,
+                        exactly as if the run had not been interrupted.""")
+    parser.add_argument('-eval_batch_size', type=int, default=EVAL_BATCH_SIZE,
+                        help="""Number of examples scored at a time when
+                        evaluating (0: the whole split at once).""")
+    parser.add_argument('-eval_every', type=int, default=1,
+                        help="Evaluate on the dev set every this many epochs.")
+    parser.add_argument('-eval_every_steps', type=int, default=0,
+                        help="""Evaluate every this many training steps instead
+                        (0: use -eval_every).""")
+    parser.add_argument('-eval_subsample', type=int, default=0,
+                        help="""Evaluate during training on a fixed random
+                        subset of this many dev examples (0: all of them).""")
+    parser.add_argument('-patience', type=int, default=0,
+                        help="""Stop after this many evaluations without
+                        improvement, and test the best model (0: no early
+                        stopping).""")
+    parser.add_argument('-early_stopping_metric', choices=['val_acc', 'val_loss'],
+                        default='val_acc')
+    parser.add_argument('-learning_rates', type=float, nargs='+',
+                        help="""Train one model per learning rate, all at once
+                        on the same batches (see also -l2_decays, -seeds).""")
+    parser.add_argument('-l2_decays', type=float, nargs='+',
+                        help="Train one model per L2 decay, all at once.")
+    parser.add_argument('-seeds', type=int, nargs='+',
+                        help="""Train one model per initialization seed, all at
+                        once.""")
+    return parser
+
+
+def load_data(opt):
+    """The dataset selected by opt (data_path, lazy_data)."""
+    data = utils.load_dataset(opt.data_path, lazy=opt.lazy_data, dtype='float32')
+    if opt.lazy_data:
+        return utils.LazyClassificationDataset(data)
+    return utils.ClassificationDataset(data)
+
+
+def build_model(opt, n_classes, n_feats):
+    if opt.model == 'logistic_regression':
+        return LogisticRegression(n_classes, n_feats)
+    return FeedforwardNetwork(
+        n_classes,
+        n_feats,
+        opt.hidden_size,
+        opt.layers,
+        opt.activation,
+        opt.dropout
+    )
+
+
+def run(opt, dataset):
+    """
+    Train and test one configuration on an already loaded dataset; returns
+    its final metrics (used by sweep.py to run many configurations).
+    """
+    if opt.learning_rates or opt.l2_decays or opt.seeds:
+        return run_stacked(opt, dataset)
 
     utils.configure_seed(seed=42)
 
-    data = utils.load_dataset(opt.data_path)
-    dataset = utils.ClassificationDataset(data)
-    train_dataloader = DataLoader(
-        dataset, batch_size=opt.batch_size, shuffle=True, generator=torch.Generator().manual_seed(42))
-    dev_X, dev_y = dataset.dev_X, dataset.dev_y
+    loader_cls = utils.BatchLoader if opt.batch_loader else DataLoader
+    generator = torch.Generator().manual_seed(42)
+    train_dataloader = loader_cls(
+        dataset, batch_size=opt.batch_size, shuffle=True, generator=generator)
+    dev_X, dev_y = utils.subsample(dataset.dev_X, dataset.dev_y, opt.eval_subsample)
     test_X, test_y = dataset.test_X, dataset.test_y
 
     n_classes = torch.unique(dataset.y).shape[0]  # 10
-    n_feats = dataset.X.shape[1]
+    n_feats = dataset.n_features
 
     # initialize the model
-    if opt.model == 'logistic_regression':
-        model = LogisticRegression(n_classes, n_feats)
-    else:
-        model = FeedforwardNetwork(
-            n_classes,
-            n_feats,
-            opt.hidden_size,
-            opt.layers,
-            opt.activation,
-            opt.dropout
-        )
+    model = build_model(opt, n_classes, n_feats)
 
     # get an optimizer
     optims = {"adam": torch.optim.Adam, "sgd": torch.optim.SGD}
 
     optim_cls = optims[opt.optimizer]
+    # Adam has no momentum argument
+    optim_kwargs = {'momentum': opt.momentum} if opt.optimizer == 'sgd' else {}
     optimizer = optim_cls(
-        model.parameters(), lr=opt.learning_rate, weight_decay=opt.l2_decay, momentum = opt.momentum
+        model.parameters(), lr=opt.learning_rate, weight_decay=opt.l2_decay, **optim_kwargs
     )
 
     # get a loss criterion
@@ -244,39 +466,17 @@ def main():
     train_losses = []
     valid_losses = []
     valid_accs = []
-
-    start = time.time()
-
-    print('initial val acc: {:.4f}'.format(evaluate(model, dev_X, dev_y, criterion)[1]))
-
-    for ii in epochs:
-        print('Training epoch {}'.format(ii))
-        epoch_train_losses = []
-        for X_batch, y_batch in train_dataloader:
-            loss = train_batch(
-                X_batch, y_batch, model, optimizer, criterion)
-            epoch_train_losses.append(loss)
-
-        epoch_train_loss = torch.tensor(epoch_train_losses).mean().item()
-        val_loss, val_acc = evaluate(model, dev_X, dev_y, criterion)
-
-        print('train loss: {:.4f} | val loss: {:.4f} | val acc: {:.4f}'.format(
-            epoch_train_loss, val_loss, val_acc
-        ))
-
-        train_losses.append(epoch_train_loss)
-        valid_losses.append(val_loss)
-        valid_accs.append(val_acc)
-
-    elapsed_time = time.time() - start
-    minutes = int(elapsed_time // 60)
-    seconds = int(elapsed_time % 60)
-    print('Training took {} minutes and {} seconds'.format(minutes, seconds))
-
-    _, test_acc = evaluate(model, test_X, test_y, criterion)
-    print('Final test acc: {:.4f}'.format(test_acc))
-
-    # plot
+    # (fractional) epoch of each evaluation
+    eval_positions = []
+    # peak memory of each evaluation, for the timing log
+    eval_used_mbs = []
+    steps_per_epoch = len(train_dataloader)
+    step = 0
+    stopped = False
+    early_stopping = utils.EarlyStopping(
+        opt.patience, mode='max' if opt.early_stopping_metric == 'val_acc' else 'min')
+
+    # name shared by the timing log and the plots
     if opt.model == "logistic_regression":
         config = (
             f"batch-{opt.batch_size}-lr-{opt.learning_rate}-epochs-{opt.epochs}-"
@@ -288,15 +488,281 @@ def main():
             f"hidden-{opt.hidden_size}-dropout-{opt.dropout}-l2-{opt.l2_decay}-"
             f"layers-{opt.layers}-act-{opt.activation}-opt-{opt.optimizer}-mom-{opt.momentum}"
         )
+    if opt.patience:
+        config += f"-patience-{opt.patience}-{opt.early_stopping_metric}"
+
+    checkpointer = checkpointing.AsyncCheckpointer(
+        opt.checkpoint or f'{opt.model}-checkpoint-{config}.pt')
+    start_epoch = 1
+    if opt.resume and os.path.exists(checkpointer.path):
+        state = checkpointer.load()
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        checkpointing.set_rng_state(state['rng'], [generator])
+        train_losses = state['history']['train_losses']
+        valid_losses = state['history']['valid_losses']
+        valid_accs = state['history']['valid_accs']
+        eval_positions = state['history']['eval_positions']
+        early_stopping.load_state_dict(state['early_stopping'])
+        step = state['step']
+        stopped = state['stopped']
+        start_epoch = state['epoch'] + 1
+        print('Resuming after epoch {} from {}'.format(state['epoch'], checkpointer.path))
+
+    logger = instrumentation.EpochLogger(
+        f'{opt.model}-timings-{config}.jsonl', append=start_epoch > 1, **vars(opt))
+
+    def validate(position):
+        """Evaluate on the dev set; returns True when training should stop."""
+        with logger.phase('evaluation'), instrumentation.track_peak_memory() as memory:
+            val_loss, val_acc = evaluate(
+                model, dev_X, dev_y, criterion, batch_size=opt.eval_batch_size)
+        print('val loss: {:.4f} | val acc: {:.4f}'.format(val_loss, val_acc))
+        eval_used_mbs.append(memory['used_mb'])
+        valid_losses.append(val_loss)
+        valid_accs.append(val_acc)
+        eval_positions.append(position)
+        metric = val_acc if opt.early_stopping_metric == 'val_acc' else val_loss
+        return early_stopping.step(metric, model, position)
+
+    start = time.time()
+
+    if start_epoch == 1:
+        print('initial val acc: {:.4f}'.format(
+            evaluate(model, dev_X, dev_y, criterion, batch_size=opt.eval_batch_size)[1]))
+
+    try:
+        for ii in epochs[start_epoch - 1:]:
+            if stopped:
+                break
+            print('Training epoch {}'.format(ii))
+            logger.start_epoch(ii)
+            n_evals = len(valid_accs)
+            epoch_train_losses = []
+            for X_batch, y_batch in logger.timed(train_dataloader):
+                loss = train_batch(
+                    X_batch, y_batch, model, optimizer, criterion, timer=logger)
+                epoch_train_losses.append(loss)
+                logger.add_examples(y_batch.shape[0])
+                step += 1
+                if opt.eval_every_steps > 0 and step % opt.eval_every_steps == 0:
+                    stopped = validate(step / steps_per_epoch)
+                    if stopped:
+                        break
+
+            epoch_train_loss = torch.tensor(epoch_train_losses).mean().item()
+            print('train loss: {:.4f}'.format(epoch_train_loss))
+            if opt.eval_every_steps > 0:
+                # the last model is always evaluated
+                evaluate_now = ii == opt.epochs and step % opt.eval_every_steps != 0
+            else:
+                evaluate_now = ii % opt.eval_every == 0 or ii == opt.epochs
+            if evaluate_now and not stopped:
+                stopped = validate(int(ii))
+            train_losses.append(epoch_train_loss)
+            if len(valid_accs) > n_evals:
+                logger.end_epoch(train_loss=epoch_train_loss, val_loss=valid_losses[-1],
+                                 val_acc=valid_accs[-1], eval_used_mb=eval_used_mbs[-1])
+            else:
+                logger.end_epoch(train_loss=epoch_train_loss)
+            if stopped:
+                print('No improvement in {} evaluations, stopping'.format(opt.patience))
+
+            if opt.checkpoint_every > 0 and (
+                    ii % opt.checkpoint_every == 0 or ii == opt.epochs or stopped):
+                checkpointer.save({
+                    'epoch': int(ii),
+                    'model': model.state_dict(),
+                    'optimizer': optimizer.state_dict(),
+                    'rng': checkpointing.rng_state([generator]),
+                    'history': {'train_losses': train_losses, 'valid_losses': valid_losses,
+                                'valid_accs': valid_accs, 'eval_positions': eval_positions},
+                    'early_stopping': early_stopping.state_dict(),
+                    'step': step,
+                    'stopped': stopped,
+                })
+    finally:
+        checkpointer.close()
+        logger.close()
+    elapsed_time = time.time() - start
+    minutes = int(elapsed_time // 60)
+    seconds = int(elapsed_time % 60)
+    print('Training took {} minutes and {} seconds'.format(minutes, seconds))
+    epochs = epochs[:len(train_losses)]
+
+    best = None
+    if opt.patience and early_stopping.best_state is not None:
+        # report and test the best model rather than the last one
+        model.load_state_dict(early_stopping.best_state)
+        best = early_stopping.best_position
+        print('Best model: epoch {:.2f}'.format(best))
+    if (opt.patience or opt.eval_subsample or not eval_positions
+            or eval_positions[-1] != len(train_losses)):
+        # the last evaluation is not of this model on the whole dev set
+        val_loss, val_acc = evaluate(
+            model, dataset.dev_X, dataset.dev_y, criterion, batch_size=opt.eval_batch_size)
+    else:
+        val_loss, val_acc = valid_losses[-1], valid_accs[-1]
+    with instrumentation.track_peak_memory() as memory:
+        _, test_acc = evaluate(model, test_X, test_y, criterion, batch_size=opt.eval_batch_size)
+    print('Final val acc: {:.4f}'.format(val_acc))
+    print('Final test acc: {:.4f}'.format(test_acc))
+    print('Test evaluation memory: {:.1f} MB above the {:.1f} MB in use before it'.format(
+        memory['used_mb'], memory['start_mb']))
 
+    # plot
     losses = {
         "Train Loss": train_losses,
-        "Valid Loss": valid_losses,
+        "Valid Loss": (eval_positions, valid_losses),
+    }
+
+    plot(epochs, losses, filename=f'{opt.model}-training-loss-{config}.pdf', best=best)
+    accuracy = { "Valid Accuracy": (eval_positions, valid_accs) }
+    plot(epochs, accuracy, filename=f'{opt.model}-validation-accuracy-{config}.pdf', best=best)
+
+    return {
+        'train_loss': train_losses[-1] if train_losses else None,
+        'val_loss': val_loss,
+        'val_acc': val_acc,
+        'best_val_acc': max(valid_accs, default=None),
+        'best_epoch': early_stopping.best_position,
+        'epochs': len(train_losses),
+        'test_acc': test_acc,
+        'eval_used_mb': memory['used_mb'],
+        'train_time': elapsed_time,
+    }
+
+
+# options of the single-model loop that run_stacked does not implement
+STACKED_UNSUPPORTED = (
+    'patience', 'early_stopping_metric', 'eval_every', 'eval_every_steps', 'eval_subsample',
+    'checkpoint', 'checkpoint_every', 'resume')
+
+
+def stacked_conflicts(opt):
+    """Options given with -learning_rates / -l2_decays / -seeds that would be ignored."""
+    if not (opt.learning_rates or opt.l2_decays or opt.seeds):
+        return []
+    parser = build_parser()
+    return ['-' + name for name in STACKED_UNSUPPORTED
+            if getattr(opt, name) != parser.get_default(name)]
+
+
+def run_stacked(opt, dataset):
+    """
+    Train the models given by -learning_rates, -l2_decays and -seeds (each
+    a single value or one per model; -learning_rate, -l2_decay and seed 42
+    otherwise) together with StackedModels. Returns the final metrics of
+    every model, as lists. Stacked runs are not checkpointed.
+    """
+    configs = {
+        'learning_rate': opt.learning_rates or [opt.learning_rate],
+        'l2_decay': opt.l2_decays or [opt.l2_decay],
+        'seed': opt.seeds or [42],
+    }
+    conflicts = stacked_conflicts(opt)
+    if conflicts:
+        raise ValueError(
+            '{} cannot be used when training stacked models'.format(', '.join(conflicts)))
+    n_models = max(len(values) for values in configs.values())
+    for name, values in configs.items():
+        if len(values) not in (1, n_models):
+            raise ValueError(
+                'Got {} values of {} for {} models'.format(len(values), name, n_models))
+        configs[name] = values * (n_models // len(values))
+
+    utils.configure_seed(seed=42)
+
+    loader_cls = utils.BatchLoader if opt.batch_loader else DataLoader
+    train_dataloader = loader_cls(
+        dataset, batch_size=opt.batch_size, shuffle=True, generator=torch.Generator().manual_seed(42))
+    dev_X, dev_y = dataset.dev_X, dataset.dev_y
+    test_X, test_y = dataset.test_X, dataset.test_y
+
+    n_classes = torch.unique(dataset.y).shape[0]
+    n_feats = dataset.n_features
+
+    # each model is initialized as a single run with its seed would be
+    models = []
+    for seed in configs['seed']:
+        torch.manual_seed(seed)
+        models.append(build_model(opt, n_classes, n_feats))
+    models = StackedModels(
+        models, configs['learning_rate'], configs['l2_decay'],
+        optimizer=opt.optimizer, momentum=opt.momentum)
+    labels = ['lr-{}-l2-{}-seed-{}'.format(*values) for values in zip(*configs.values())]
+
+    epochs = torch.arange(1, opt.epochs + 1)
+    train_losses = []
+    valid_losses = []
+    valid_accs = []
+
+    config = (
+        f"stacked-{n_models}-batch-{opt.batch_size}-epochs-{opt.epochs}-opt-{opt.optimizer}"
+    )
+    logger = instrumentation.EpochLogger(f'{opt.model}-timings-{config}.jsonl', **vars(opt))
+
+    start = time.time()
+    for ii in epochs:
+        print('Training epoch {}'.format(ii))
+        logger.start_epoch(ii)
+        epoch_train_losses = []
+        for X_batch, y_batch in logger.timed(train_dataloader):
+            losses = train_batch_stacked(X_batch, y_batch, models, timer=logger)
+            epoch_train_losses.append(losses)
+            logger.add_examples(y_batch.shape[0] * n_models)
+
+        epoch_train_loss = torch.tensor(epoch_train_losses).mean(dim=0).tolist()
+        with logger.phase('evaluation'):
+            val_loss, val_acc = evaluate_stacked(
+                models, dev_X, dev_y, batch_size=opt.eval_batch_size)
+        metrics = {}
+        for i in range(n_models):
+            metrics.update({'train_loss_{}'.format(i): epoch_train_loss[i],
+                            'val_loss_{}'.format(i): val_loss[i],
+                            'val_acc_{}'.format(i): val_acc[i]})
+        logger.end_epoch(**metrics)
+
+        for label, model_train_loss, model_val_loss, model_val_acc in zip(
+                labels, epoch_train_loss, val_loss, val_acc):
+            print('{} | train loss: {:.4f} | val loss: {:.4f} | val acc: {:.4f}'.format(
+                label, model_train_loss, model_val_loss, model_val_acc))
+
+        train_losses.append(epoch_train_loss)
+        valid_losses.append(val_loss)
+        valid_accs.append(val_acc)
+
+    logger.close()
+    elapsed_time = time.time() - start
+    print('Training {} models took {:.1f} seconds'.format(n_models, elapsed_time))
+
+    _, test_acc = evaluate_stacked(models, test_X, test_y, batch_size=opt.eval_batch_size)
+    for label, model_test_acc in zip(labels, test_acc):
+        print('{} | final test acc: {:.4f}'.format(label, model_test_acc))
+
+    # one curve per model
+    plot(epochs, {label: [epoch[i] for epoch in valid_accs] for i, label in enumerate(labels)},
+         filename=f'{opt.model}-validation-accuracy-{config}.pdf')
+
+    return {
+        'models': labels,
+        'train_loss': train_losses[-1],
+        'val_loss': valid_losses[-1],
+        'val_acc': valid_accs[-1],
+        'best_val_acc': [max(epoch[i] for epoch in valid_accs) for i in range(n_models)],
+        'test_acc': test_acc,
+        'train_time': elapsed_time,
     }
 
-    plot(epochs, losses, filename=f'{opt.model}-training-loss-{config}.pdf')
-    accuracy = { "Valid Accuracy": valid_accs }
-    plot(epochs, accuracy, filename=f'{opt.model}-validation-accuracy-{config}.pdf')
+
+def main():
+    parser = build_parser()
+    opt = parser.parse_args()
+    conflicts = stacked_conflicts(opt)
+    if conflicts:
+        parser.error('{} cannot be used with -learning_rates, -l2_decays or -seeds'.format(
+            ', '.join(conflicts)))
+    run(opt, load_data(opt))
 
 
 if __name__ == '__main__':
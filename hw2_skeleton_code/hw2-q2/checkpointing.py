@@ -0,0 +1,108 @@
+import copy
+import os
+import random
+import tempfile
+import threading
+
+import numpy as np
+import torch
+
+
+def rng_state(generators=()):
+    """State of every random number generator a training run draws from."""
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+        "generators": [g.get_state() for g in generators],
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state, generators=()):
+    """Restore a state returned by rng_state (with the same generators)."""
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    for g, g_state in zip(generators, state["generators"]):
+        g.set_state(g_state)
+    if "cuda" in state:
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def default_path(path, suffix="-last"):
+    """model.pt -> model-last.pt"""
+    root, ext = os.path.splitext(path)
+    return root + suffix + ext
+
+
+class AsyncCheckpointer(object):
+    """
+    Saves training checkpoints to path on a background thread. save()
+    copies the state (tensors are cloned to the CPU) before returning, so
+    training can go on while the copy is written. Each checkpoint is written
+    to a temporary file and renamed over path, so a run killed mid-write
+    leaves the previous checkpoint intact.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.thread = None
+        self.error = None
+
+    @staticmethod
+    def _snapshot(state):
+        if isinstance(state, torch.Tensor):
+            return state.detach().to("cpu", copy=True)
+        if isinstance(state, dict):
+            return {k: AsyncCheckpointer._snapshot(v) for k, v in state.items()}
+        if isinstance(state, (list, tuple)):
+            return type(state)(AsyncCheckpointer._snapshot(v) for v in state)
+        return copy.deepcopy(state)
+
+    def _write(self, snapshot):
+        tmp_path = None
+        try:
+            # a temporary file of its own, in case other processes write
+            # checkpoints to the same path
+            fd, tmp_path = tempfile.mkstemp(
+                prefix=os.path.basename(self.path) + ".", suffix=".tmp",
+                dir=os.path.dirname(self.path) or ".")
+            with os.fdopen(fd, "wb") as f:
+                torch.save(snapshot, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            self.error = e
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def save(self, state):
+        """state: dict of tensors, state_dicts, numbers and lists"""
+        self.wait()
+        snapshot = self._snapshot(state)
+        self.thread = threading.Thread(target=self._write, args=(snapshot,), daemon=True)
+        self.thread.start()
+
+    def wait(self):
+        """Block until the last checkpoint is on disk; re-raises its error."""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        self.wait()
+
+    def load(self, map_location="cpu"):
+        """
+        The last checkpoint saved at path. Loaded on the CPU by default:
+        the RNG states must stay there, and load_state_dict moves model and
+        optimizer states to the device of the parameters.
+        """
+        return torch.load(self.path, map_location=map_location, weights_only=False)
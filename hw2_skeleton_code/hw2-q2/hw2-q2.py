@@ -3,6 +3,7 @@
 # Deep Learning Homework 2
 
 import argparse
+import os
 
 import torch
 from torch.utils.data import DataLoader
@@ -11,8 +12,14 @@ import torch.nn.functional as F
 from matplotlib import pyplot as plt
 import numpy as np
 
+import checkpointing
+import instrumentation
 import utils
 
+# examples scored at a time when evaluating; the activations of the first
+# conv block alone take 48 x 48 x 32 floats per example
+EVAL_BATCH_SIZE = 256
+
 device = torch.device('mps' if torch.backends.mps.is_available() else 'cpu')
 print(device)
 
@@ -127,7 +134,7 @@ class CNN(nn.Module):
         if self.batch_norm: 
             x = self.mlp_batchnorm(x)
 
-        x = self.mlp_out(F.relu(self.mlp_layer_2(F.dropout(F.relu(x), 0.1))))
+        x = self.mlp_out(F.relu(self.mlp_layer_2(self.dropout(F.relu(x)))))
 
        
         
@@ -135,19 +142,25 @@ class CNN(nn.Module):
         return F.log_softmax(x, dim=1)
  
 
-def train_batch(X, y, model, optimizer, criterion, **kwargs):
+def train_batch(X, y, model, optimizer, criterion, timer=None, **kwargs):
     """
     X (n_examples x n_features)
     y (n_examples): gold labels
     model: a PyTorch defined model
     optimizer: optimizer used in gradient step
     criterion: loss function
+    timer: optional instrumentation.EpochLogger charged with the forward,
+    backward and optimizer phases
     """
-    optimizer.zero_grad()
-    out = model(X, **kwargs)
-    loss = criterion(out, y)
-    loss.backward()
-    optimizer.step()
+    phase = timer.phase if timer is not None else instrumentation.no_phase
+    with phase('forward'):
+        optimizer.zero_grad()
+        out = model(X, **kwargs)
+        loss = criterion(out, y)
+    with phase('backward'):
+        loss.backward()
+    with phase('optimizer'):
+        optimizer.step()
     return loss.item()
 
 
@@ -162,26 +175,25 @@ def predict(model, X, return_scores=True):
         return predicted_labels
 
 
-def evaluate(model, X, y, criterion=None):
+def evaluate(model, X, y, criterion=None, batch_size=EVAL_BATCH_SIZE):
     """
     X (n_examples x n_features)
     y (n_examples): gold labels
+    batch_size (int): examples scored at a time (0: all at once)
     """
     model.eval()
-    with torch.no_grad():
-        y_hat, scores = predict(model, X, return_scores=True)
-        loss = criterion(scores, y)
-        n_correct = (y == y_hat).sum().item()
-        n_possible = float(y.shape[0])
-
-    return n_correct / n_possible, loss
+    with torch.inference_mode():
+        return utils.chunked_evaluate(model, X, y, batch_size, loss_fn=criterion)
 
 
-def plot(epochs, plottable, ylabel='', name=''):
+def plot(epochs, plottable, ylabel='', name='', best=None):
+    """best: epoch of the model that was kept, marked on the plot"""
     plt.figure()#plt.clf()
     plt.xlabel('Epoch')
     plt.ylabel(ylabel)
     plt.plot(epochs, plottable)
+    if best is not None:
+        plt.axvline(best, color='gray', linestyle='--')
     plt.savefig('%s.pdf' % (name), bbox_inches='tight')
 
 
@@ -202,7 +214,7 @@ def plot_file_name_sufix(opt, exlude):
     return '-'.join([str(value) for name, value in vars(opt).items() if name not in exlude])
 
 
-def main():
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-epochs', default=40, type=int,
                         help="""Number of epochs to train for. You should not
@@ -219,18 +231,71 @@ def main():
     parser.add_argument('-no_batch_norm', action='store_true')
     parser.add_argument('-data_path', type=str, default='landscapes.v2.npz',)
     parser.add_argument('-device', choices=['cpu', 'cuda', 'mps'], default='cpu')
-
-    opt = parser.parse_args()
-
+    parser.add_argument('-lazy_data', action='store_true',
+                        help="""Memory-map a uint8 cache of the dataset and
+                        normalize examples when they are indexed.""")
+    parser.add_argument('-batch_loader', action='store_true',
+                        help="""Build each training batch with one index-select
+                        instead of a DataLoader (same batches, same seed).""")
+    parser.add_argument('-prefetch', action='store_true',
+                        help="""Assemble and move the next batches to the device
+                        on a background thread while the current step runs.""")
+    parser.add_argument('-sync_phases', action='store_true',
+                        help="""On CUDA, wait for the device at the end of every
+                        timed phase, not only of every epoch (exact phase
+                        times, but no overlap with -prefetch).""")
+    parser.add_argument('-checkpoint', type=str, default=None,
+                        help="""Checkpoint file (default: named after the
+                        configuration, like the plots).""")
+    parser.add_argument('-checkpoint_every', type=int, default=1,
+                        help="""Save a checkpoint every this many epochs, on a
+                        background thread (0 to disable).""")
+    parser.add_argument('-resume', action='store_true',
+                        help="""Continue from the checkpoint, if there is one,
+                        exactly as if the run had not been interrupted.""")
+    parser.add_argument('-eval_batch_size', type=int, default=EVAL_BATCH_SIZE,
+                        help="""Number of examples scored at a time when
+                        evaluating (0: the whole split at once).""")
+    parser.add_argument('-eval_every', type=int, default=1,
+                        help="Evaluate on the dev set every this many epochs.")
+    parser.add_argument('-eval_every_steps', type=int, default=0,
+                        help="""Evaluate every this many training steps instead
+                        (0: use -eval_every).""")
+    parser.add_argument('-eval_subsample', type=int, default=0,
+                        help="""Evaluate during training on a fixed random
+                        subset of this many dev examples (0: all of them).""")
+    parser.add_argument('-patience', type=int, default=0,
+                        help="""Stop after this many evaluations without
+                        improvement, and test the best model (0: no early
+                        stopping).""")
+    parser.add_argument('-early_stopping_metric', choices=['val_acc', 'val_loss'],
+                        default='val_acc')
+    return parser
+
+
+def load_data(opt):
+    """The dataset selected by opt (data_path, lazy_data)."""
+    data = utils.load_dataset(data_path=opt.data_path, lazy=opt.lazy_data)
+    if opt.lazy_data:
+        return utils.LazyClassificationDataset(data)
+    return utils.ClassificationDataset(data)
+
+
+def run(opt, dataset):
+    """
+    Train and test one configuration on an already loaded dataset; returns
+    its final metrics (used by sweep.py to run many configurations).
+    """
     # Setting seed for reproducibility
     utils.configure_seed(seed=42)
 
-    # Load data
-    data = utils.load_dataset(data_path=opt.data_path)
-    dataset = utils.ClassificationDataset(data)
-    train_dataloader = DataLoader(
+    loader_cls = utils.BatchLoader if opt.batch_loader else DataLoader
+    train_dataloader = loader_cls(
         dataset, batch_size=opt.batch_size, shuffle=True)
-    dev_X, dev_y = dataset.dev_X.to(opt.device), dataset.dev_y.to(opt.device)
+    if opt.prefetch:
+        train_dataloader = utils.Prefetcher(train_dataloader, opt.device)
+    dev_X, dev_y = utils.subsample(dataset.dev_X, dataset.dev_y, opt.eval_subsample)
+    dev_X, dev_y = dev_X.to(opt.device), dev_y.to(opt.device)
     test_X, test_y = dataset.test_X.to(opt.device), dataset.test_y.to(opt.device)
 
     # initialize the model
@@ -251,41 +316,180 @@ def main():
     # get a loss criterion
     criterion = nn.NLLLoss()
 
+    sufix = plot_file_name_sufix(
+        opt, exlude={'data_path', 'device', 'lazy_data', 'batch_loader', 'prefetch',
+                     'checkpoint', 'checkpoint_every', 'resume', 'eval_batch_size', 'eval_every',
+                     'eval_every_steps', 'eval_subsample', 'patience',
+                     'early_stopping_metric', 'sync_phases'})
+    if opt.patience:
+        sufix += '-patience-{}-{}'.format(opt.patience, opt.early_stopping_metric)
+
     # training loop
     epochs = np.arange(1, opt.epochs + 1)
     train_mean_losses = []
     valid_accs = []
+    valid_losses = []
     train_losses = []
-    for ii in epochs:
-        print('\nTraining epoch {}'.format(ii))
-        model.train()
-        for X_batch, y_batch in train_dataloader:
-            X_batch = X_batch.to(opt.device)
-            y_batch = y_batch.to(opt.device)
-            loss = train_batch(
-                X_batch, y_batch, model, optimizer, criterion)
-            train_losses.append(loss)
-
-        mean_loss = torch.tensor(train_losses).mean().item()
-        print('Training loss: %.4f' % (mean_loss))
-
-        train_mean_losses.append(mean_loss)
-        val_acc, val_loss = evaluate(model, dev_X, dev_y, criterion)
-        valid_accs.append(val_acc)
+    # (fractional) epoch of each evaluation
+    eval_positions = []
+    # peak memory of each evaluation, for the timing log
+    eval_used_mbs = []
+    steps_per_epoch = len(train_dataloader)
+    step = 0
+    stopped = False
+    early_stopping = utils.EarlyStopping(
+        opt.patience, mode='max' if opt.early_stopping_metric == 'val_acc' else 'min')
+
+    checkpointer = checkpointing.AsyncCheckpointer(
+        opt.checkpoint or 'CNN-3-checkpoint-{}.pt'.format(sufix))
+    start_epoch = 1
+    if opt.resume and os.path.exists(checkpointer.path):
+        state = checkpointer.load()
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        checkpointing.set_rng_state(state['rng'])
+        train_mean_losses = state['history']['train_mean_losses']
+        valid_accs = state['history']['valid_accs']
+        valid_losses = state['history']['valid_losses']
+        train_losses = state['history']['train_losses']
+        eval_positions = state['history']['eval_positions']
+        early_stopping.load_state_dict(state['early_stopping'])
+        step = state['step']
+        stopped = state['stopped']
+        start_epoch = state['epoch'] + 1
+        print('Resuming after epoch {} from {}'.format(state['epoch'], checkpointer.path))
+
+    sync = torch.cuda.synchronize if opt.device == 'cuda' else None
+    logger = instrumentation.EpochLogger(
+        'CNN-3-timings-{}.jsonl'.format(sufix), sync=sync, per_phase_sync=opt.sync_phases,
+        append=start_epoch > 1, **vars(opt))
+
+    def validate(position):
+        """Evaluate on the dev set; returns True when training should stop."""
+        with logger.phase('evaluation'), instrumentation.track_peak_memory(opt.device) as memory:
+            val_acc, val_loss = evaluate(
+                model, dev_X, dev_y, criterion, batch_size=opt.eval_batch_size)
+        eval_used_mbs.append(memory['used_mb'])
         print("Valid loss: %.4f" % val_loss)
         print('Valid acc: %.4f' % val_acc)
-
-    test_acc, _ = evaluate(model, test_X, test_y, criterion)
+        valid_accs.append(val_acc)
+        valid_losses.append(val_loss)
+        eval_positions.append(position)
+        metric = val_acc if opt.early_stopping_metric == 'val_acc' else val_loss
+        return early_stopping.step(metric, model, position)
+
+    try:
+        for ii in epochs[start_epoch - 1:]:
+            if stopped:
+                break
+            print('\nTraining epoch {}'.format(ii))
+            logger.start_epoch(ii)
+            n_evals = len(valid_accs)
+            model.train()
+            for X_batch, y_batch in logger.timed(train_dataloader):
+                with logger.phase('data'):
+                    X_batch = X_batch.to(opt.device)
+                    y_batch = y_batch.to(opt.device)
+                loss = train_batch(
+                    X_batch, y_batch, model, optimizer, criterion, timer=logger)
+                train_losses.append(loss)
+                logger.add_examples(y_batch.shape[0])
+                step += 1
+                if opt.eval_every_steps > 0 and step % opt.eval_every_steps == 0:
+                    stopped = validate(step / steps_per_epoch)
+                    # evaluate() leaves the model in eval mode
+                    model.train()
+                    if stopped:
+                        break
+
+            mean_loss = torch.tensor(train_losses).mean().item()
+            print('Training loss: %.4f' % (mean_loss))
+            if opt.prefetch:
+                print('Data wait: %.4fs' % train_dataloader.wait_time)
+
+            train_mean_losses.append(mean_loss)
+            if opt.eval_every_steps > 0:
+                # the last model is always evaluated
+                evaluate_now = ii == opt.epochs and step % opt.eval_every_steps != 0
+            else:
+                evaluate_now = ii % opt.eval_every == 0 or ii == opt.epochs
+            if evaluate_now and not stopped:
+                stopped = validate(int(ii))
+            if len(valid_accs) > n_evals:
+                logger.end_epoch(train_loss=mean_loss, val_loss=valid_losses[-1],
+                                 val_acc=valid_accs[-1], eval_used_mb=eval_used_mbs[-1])
+            else:
+                logger.end_epoch(train_loss=mean_loss)
+            if stopped:
+                print('No improvement in {} evaluations, stopping'.format(opt.patience))
+
+            if opt.checkpoint_every > 0 and (
+                    ii % opt.checkpoint_every == 0 or ii == opt.epochs or stopped):
+                checkpointer.save({
+                    'epoch': int(ii),
+                    'model': model.state_dict(),
+                    'optimizer': optimizer.state_dict(),
+                    'rng': checkpointing.rng_state(),
+                    'history': {'train_mean_losses': train_mean_losses, 'valid_accs': valid_accs,
+                                'valid_losses': valid_losses, 'train_losses': train_losses,
+                                'eval_positions': eval_positions},
+                    'early_stopping': early_stopping.state_dict(),
+                    'step': step,
+                    'stopped': stopped,
+                })
+    finally:
+        checkpointer.close()
+        logger.close()
+    epochs = epochs[:len(train_mean_losses)]
+
+    best = None
+    if opt.patience and early_stopping.best_state is not None:
+        # report and test the best model rather than the last one
+        model.load_state_dict(early_stopping.best_state)
+        best = early_stopping.best_position
+        print('Best model: epoch %.2f' % best)
+    if (opt.patience or opt.eval_subsample or not eval_positions
+            or eval_positions[-1] != len(train_mean_losses)):
+        # the last evaluation is not of this model on the whole dev set
+        val_acc, val_loss = evaluate(
+            model, dataset.dev_X.to(opt.device), dataset.dev_y.to(opt.device), criterion,
+            batch_size=opt.eval_batch_size)
+    else:
+        val_acc, val_loss = valid_accs[-1], valid_losses[-1]
+    with instrumentation.track_peak_memory(opt.device) as memory:
+        test_acc, _ = evaluate(model, test_X, test_y, criterion, batch_size=opt.eval_batch_size)
     test_acc_perc = test_acc * 100
     test_acc_str = '%.2f' % test_acc_perc
     print('Final Test acc: %.4f' % test_acc)
+    print('Test evaluation memory: %.1f MB above the %.1f MB in use before it' % (
+        memory['used_mb'], memory['start_mb']))
     # plot
-    sufix = plot_file_name_sufix(opt, exlude={'data_path', 'device'})
 
-    plot(epochs, train_mean_losses, ylabel='Loss', name='CNN-3-train-loss-{}-{}'.format(sufix, test_acc_str))
-    plot(epochs, valid_accs, ylabel='Accuracy', name='CNN-3-valid-accuracy-{}-{}'.format(sufix, test_acc_str))
+    plot(epochs, train_mean_losses, ylabel='Loss',
+         name='CNN-3-train-loss-{}-{}'.format(sufix, test_acc_str), best=best)
+    plot(eval_positions, valid_accs, ylabel='Accuracy',
+         name='CNN-3-valid-accuracy-{}-{}'.format(sufix, test_acc_str), best=best)
+
+    n_params = get_number_trainable_params(model)
+    print('Number of trainable parameters: ', n_params)
+
+    return {
+        'train_loss': train_mean_losses[-1] if train_mean_losses else None,
+        'val_loss': val_loss,
+        'val_acc': val_acc,
+        'best_val_acc': max(valid_accs, default=None),
+        'best_epoch': early_stopping.best_position,
+        'epochs': len(train_mean_losses),
+        'test_acc': test_acc,
+        'n_params': n_params,
+        'eval_used_mb': memory['used_mb'],
+    }
+
+
+def main():
+    opt = build_parser().parse_args()
+    run(opt, load_data(opt))
 
-    print('Number of trainable parameters: ', get_number_trainable_params(model))
 
 if __name__ == '__main__':
     main()
@@ -1,5 +1,12 @@
+import hashlib
+import itertools
+import json
+import os
+
+import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import Dataset, Sampler
 
 PAD_IDX = 0
 SOS_IDX = 1
@@ -9,20 +16,31 @@ MAX_LENGTH = 20
 
 
 class Vocabulary:
+    """
+    Once frozen (see freeze), no words can be added and whole batches are
+    encoded and decoded with encode_many/decode_many.
+    """
     def __init__(self):
         self.word2index = {}
         self.index2word = {0: "PAD", 1: "SOS", 2: "EOS", 3: "UNK"}
+        self.frozen = False
 
     @property
     def vocab_size(self):
         return len(self.index2word)
 
+    def words(self):
+        """Added words (no specials), in index order."""
+        return [self.index2word[i] for i in range(UNK_IDX + 1, self.vocab_size)]
+
     def add_sentence(self, sentence):
         for word in sentence:
             self.add_word(word)
 
     def add_word(self, word):
         if word not in self.word2index:
+            if self.frozen:
+                raise ValueError("cannot add %r to a frozen vocabulary" % (word,))
             current_vocab_size = self.vocab_size
             self.word2index[word] = current_vocab_size
             self.index2word[current_vocab_size] = word
@@ -47,11 +65,127 @@ class Vocabulary:
         tokens = self.tensor2tokens(t)
         return "".join(tokens)
 
+    def freeze(self):
+        """
+        Stop adding words and build the lookup tables of the batch methods:
+        a contiguous id -> word table and, when every word is a single
+        character, id <-> code point arrays, so character-level batches are
+        encoded and decoded entirely in NumPy.
+        """
+        self.frozen = True
+        self.id2word = np.array(
+            [self.index2word[i] for i in range(self.vocab_size)], dtype=object
+        )
+        words = self.words()
+        if words and all(len(word) == 1 for word in words):
+            codes = np.array([ord(word) for word in words], dtype=np.uint32)
+            # specials decode to nothing; UNK is handled separately
+            self.id2code = np.zeros(self.vocab_size, dtype=np.uint32)
+            self.id2code[UNK_IDX + 1:] = codes
+            self.code2id = np.full(int(codes.max()) + 1, UNK_IDX, dtype=np.int32)
+            self.code2id[codes] = np.arange(UNK_IDX + 1, self.vocab_size, dtype=np.int32)
+        else:
+            self.id2code = None
+            self.code2id = None
+        return self
+
+    def encode_csr(self, sentences, add_specials=False):
+        """
+        Encode tokenized sentences into a flat int32 token array and an int64
+        offsets array of length len(sentences) + 1 (sentence i is
+        tokens[offsets[i]:offsets[i + 1]]).
+        """
+        if not self.frozen:
+            self.freeze()
+        lengths = np.fromiter(map(len, sentences), dtype=np.int64, count=len(sentences))
+        n_tokens = int(lengths.sum())
+        text = None
+        if self.code2id is not None:
+            text = "".join(itertools.chain.from_iterable(sentences))
+        if text is not None and len(text) == n_tokens:
+            # one character per token: look up the code points of the whole corpus
+            codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+            ids = np.full(n_tokens, UNK_IDX, dtype=np.int32)
+            known = codes < len(self.code2id)
+            ids[known] = self.code2id[codes[known]]
+        else:
+            lookup = self.word2index.get
+            ids = np.fromiter(
+                (lookup(word, UNK_IDX) for word in itertools.chain.from_iterable(sentences)),
+                dtype=np.int32,
+                count=n_tokens,
+            )
+        if add_specials:
+            lengths += 2
+        offsets = np.zeros(len(sentences) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        if not add_specials:
+            return ids, offsets
+        tokens = np.empty(int(offsets[-1]), dtype=np.int32)
+        tokens[offsets[:-1]] = SOS_IDX
+        tokens[offsets[1:] - 1] = EOS_IDX
+        inner = np.ones(len(tokens), dtype=bool)
+        inner[offsets[:-1]] = False
+        inner[offsets[1:] - 1] = False
+        tokens[inner] = ids
+        return tokens, offsets
+
+    def encode_many(self, sentences, add_specials=False):
+        """
+        Encode tokenized sentences into a padded LongTensor
+        (n_sentences x max_len) and their lengths (n_sentences).
+        """
+        tokens, offsets = self.encode_csr(sentences, add_specials=add_specials)
+        lengths = np.diff(offsets)
+        max_len = int(lengths.max()) if len(lengths) else 0
+        mask = np.arange(max_len) < lengths[:, None]
+        padded = np.full(mask.shape, PAD_IDX, dtype=np.int64)
+        padded[mask] = tokens
+        return torch.from_numpy(padded), torch.from_numpy(lengths)
+
+    def decode_many(self, ids, lengths=None):
+        """
+        Decode a padded batch of ids (n_sequences x max_len) into strings.
+        Each sequence stops at its first EOS (or after lengths[i] ids); SOS
+        and PAD ids are skipped.
+        """
+        if not self.frozen:
+            self.freeze()
+        ids = torch.as_tensor(ids).cpu().numpy()
+        n, max_len = ids.shape
+        if max_len == 0:
+            return [""] * n
+        is_eos = ids == EOS_IDX
+        ends = np.where(is_eos.any(1), is_eos.argmax(1), max_len)
+        if lengths is not None:
+            ends = np.minimum(ends, torch.as_tensor(lengths).cpu().numpy())
+        keep = (np.arange(max_len) < ends[:, None]) & (ids != SOS_IDX) & (ids != PAD_IDX)
+
+        if self.id2code is not None and not (keep & (ids == UNK_IDX)).any():
+            # move the kept code points of each row to its front (stable, so
+            # in order) and read every row as one NUL-padded string
+            codes = np.where(keep, self.id2code[ids], 0).astype(np.uint32)
+            order = np.argsort(~keep, axis=1, kind="stable")
+            codes = np.ascontiguousarray(np.take_along_axis(codes, order, axis=1))
+            return codes.view("<U%d" % max_len).ravel().tolist()
+        words = self.id2word[ids]
+        return ["".join(row[row_keep]) for row, row_keep in zip(words, keep)]
+
 
 class Seq2SeqDataset(Dataset):
     """
     src_tokenizer and tgt_tokenizer defaults are designed with phoneme-to-grapheme
     in mind.
+
+    The corpus is encoded once into flat int32 token arrays with offsets
+    (example i is tokens[offsets[i]:offsets[i + 1]]; targets include SOS and
+    EOS), so __getitem__ returns zero-copy slices. targets holds the gold
+    target strings.
+
+    cache: save the encoded corpus (and the vocabularies built from it) next
+    to data_tsv and memory-map it on later runs, skipping tokenization. The
+    cache is keyed by the hash of the TSV, the tokenizers, max_length and the
+    given vocabularies.
     """
     def __init__(
         self,
@@ -60,9 +194,26 @@ class Seq2SeqDataset(Dataset):
         tgt_vocab=None,
         src_tokenizer=str.split,
         tgt_tokenizer=list,
-        max_length=None
+        max_length=None,
+        cache=False,
     ):
-        self.pairs = read_tsv_corpus(
+        if cache:
+            cache_dir = corpus_cache_dir(
+                data_tsv, src_vocab, tgt_vocab, src_tokenizer, tgt_tokenizer, max_length
+            )
+            if not os.path.exists(os.path.join(cache_dir, "complete")):
+                self._encode(data_tsv, src_vocab, tgt_vocab, src_tokenizer, tgt_tokenizer, max_length)
+                self._save(cache_dir)
+            self._load(cache_dir, src_vocab, tgt_vocab)
+        else:
+            self._encode(data_tsv, src_vocab, tgt_vocab, src_tokenizer, tgt_tokenizer, max_length)
+        # the vocabularies are final once the corpus is encoded
+        for vocab in (self.src_vocab, self.tgt_vocab):
+            if not vocab.frozen:
+                vocab.freeze()
+
+    def _encode(self, data_tsv, src_vocab, tgt_vocab, src_tokenizer, tgt_tokenizer, max_length):
+        pairs = read_tsv_corpus(
             data_tsv,
             max_length=max_length,
             src_tokenizer=src_tokenizer,
@@ -73,28 +224,95 @@ class Seq2SeqDataset(Dataset):
             self.src_vocab = src_vocab
         else:
             self.src_vocab = Vocabulary()
-            for p in self.pairs:
+            for p in pairs:
                 self.src_vocab.add_sentence(p[0])
 
         if tgt_vocab is not None:
             self.tgt_vocab = tgt_vocab
         else:
             self.tgt_vocab = Vocabulary()
-            for p in self.pairs:
+            for p in pairs:
                 self.tgt_vocab.add_sentence(p[1])
 
+        self.src_tokens, self.src_offsets = self.src_vocab.encode_csr([p[0] for p in pairs])
+        self.tgt_tokens, self.tgt_offsets = self.tgt_vocab.encode_csr(
+            [p[1] for p in pairs], add_specials=True
+        )
+        self.targets = ["".join(p[1]) for p in pairs]
+
+    def _save(self, cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+        for name in ("src_tokens", "src_offsets", "tgt_tokens", "tgt_offsets"):
+            np.save(os.path.join(cache_dir, name + ".npy"), getattr(self, name))
+        with open(os.path.join(cache_dir, "targets.json"), "w", encoding="utf-8") as f:
+            json.dump(self.targets, f)
+        for name in ("src_vocab", "tgt_vocab"):
+            with open(os.path.join(cache_dir, name + ".json"), "w", encoding="utf-8") as f:
+                json.dump(getattr(self, name).words(), f)
+        open(os.path.join(cache_dir, "complete"), "w").close()
+
+    def _load(self, cache_dir, src_vocab, tgt_vocab):
+        for name in ("src_tokens", "src_offsets", "tgt_tokens", "tgt_offsets"):
+            # plain ndarray views of the maps: slicing np.memmap objects is slow
+            array = np.load(os.path.join(cache_dir, name + ".npy"), mmap_mode="c")
+            setattr(self, name, np.asarray(array))
+        with open(os.path.join(cache_dir, "targets.json"), encoding="utf-8") as f:
+            self.targets = json.load(f)
+        for name, vocab in (("src_vocab", src_vocab), ("tgt_vocab", tgt_vocab)):
+            if vocab is None:
+                vocab = Vocabulary()
+                with open(os.path.join(cache_dir, name + ".json"), encoding="utf-8") as f:
+                    vocab.add_sentence(json.load(f))
+            setattr(self, name, vocab)
+
+    @property
+    def src_lengths(self):
+        return np.diff(self.src_offsets)
+
+    @property
+    def tgt_lengths(self):
+        return np.diff(self.tgt_offsets)
+
     def __len__(self):
-        return len(self.pairs)
+        return len(self.src_offsets) - 1
 
     def __getitem__(self, idx):
-        src = self.pairs[idx][0]
-        tgt = self.pairs[idx][1]
-
-        src_ix = self.src_vocab.string2tensor(src)
-        tgt_ix = self.tgt_vocab.string2tensor(tgt, add_specials=True)
+        src_ix = torch.from_numpy(self.src_tokens[self.src_offsets[idx]:self.src_offsets[idx + 1]])
+        tgt_ix = torch.from_numpy(self.tgt_tokens[self.tgt_offsets[idx]:self.tgt_offsets[idx + 1]])
         return src_ix, tgt_ix
 
 
+class BucketBatchSampler(Sampler):
+    """
+    Batch sampler that groups examples of similar length, so batches need
+    less padding. Each epoch the dataset is shuffled, cut into chunks of
+    batch_size * chunk_batches examples, each chunk is sorted by (source,
+    target) length and cut into batches, and the batches are shuffled.
+    Draws from generator (or the global torch RNG, as DataLoader does), so
+    the batches are reproducible under configure_seed.
+
+    Use as DataLoader(dataset, batch_sampler=BucketBatchSampler(...), ...).
+    """
+    def __init__(self, dataset, batch_size, chunk_batches=100, generator=None):
+        self.batch_size = batch_size
+        self.chunk_size = batch_size * chunk_batches
+        self.generator = generator
+        self.lengths = list(zip(dataset.src_lengths.tolist(), dataset.tgt_lengths.tolist()))
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        order = torch.randperm(len(self.lengths), generator=self.generator).tolist()
+        batches = []
+        for start in range(0, len(order), self.chunk_size):
+            chunk = sorted(order[start:start + self.chunk_size], key=self.lengths.__getitem__)
+            for b in range(0, len(chunk), self.batch_size):
+                batches.append(chunk[b:b + self.batch_size])
+        for i in torch.randperm(len(batches), generator=self.generator).tolist():
+            yield batches[i]
+
+
 def read_tsv_corpus(path, max_length=None, src_tokenizer=list, tgt_tokenizer=list):
     # previous function readLangs takes two language labels and a split and
     # returns two vocab objects with nothing in them and a set of pairs
@@ -114,17 +332,45 @@ def read_tsv_corpus(path, max_length=None, src_tokenizer=list, tgt_tokenizer=lis
     return pairs
 
 
+def corpus_cache_dir(data_tsv, src_vocab, tgt_vocab, src_tokenizer, tgt_tokenizer, max_length):
+    """Cache directory of the encoded corpus of data_tsv for these settings."""
+    key = hashlib.sha1()
+    with open(data_tsv, "rb") as f:
+        for block in iter(lambda: f.read(2 ** 20), b""):
+            key.update(block)
+    settings = [
+        getattr(src_tokenizer, "__qualname__", repr(src_tokenizer)),
+        getattr(tgt_tokenizer, "__qualname__", repr(tgt_tokenizer)),
+        max_length,
+        None if src_vocab is None else src_vocab.words(),
+        None if tgt_vocab is None else tgt_vocab.words(),
+    ]
+    key.update(json.dumps(settings).encode("utf-8"))
+    return os.path.join(data_tsv + ".cache", key.hexdigest())
+
+
 def collate_samples(samples, padding_idx):
-    batch_size = len(samples)
-    max_seq_length_x = max([x.shape[0] for x, _ in samples])
-    max_seq_length_y = max([y.shape[0] for _, y in samples])
-    X_shape = (batch_size, max_seq_length_x)
-    y_shape = (batch_size, max_seq_length_y)
-    X = torch.zeros(X_shape, dtype=torch.long).fill_(padding_idx)
-    Y = torch.zeros(y_shape, dtype=torch.long).fill_(padding_idx)
-    for i, (x, y) in enumerate(samples):
-        seq_len_x = x.shape[0]
-        seq_len_y = y.shape[0]
-        X[i, :seq_len_x] = x
-        Y[i, :seq_len_y] = y
+    xs, ys = zip(*samples)
+    X = pad_sequence(xs, batch_first=True, padding_value=padding_idx).long()
+    Y = pad_sequence(ys, batch_first=True, padding_value=padding_idx).long()
     return X, Y
+
+
+def collate_with_lengths(samples, padding_idx, sort=False):
+    """
+    Like collate_samples, but also returns the source and target lengths,
+    so they need not be recomputed from the padding. With sort=True the
+    batch is ordered by decreasing source length, as required by
+    pack_padded_sequence(..., enforce_sorted=True).
+
+    Returns X (batch_size x max_src_len), Y (batch_size x max_tgt_len),
+    X_lengths (batch_size), Y_lengths (batch_size).
+    """
+    if sort:
+        samples = sorted(samples, key=lambda sample: sample[0].shape[0], reverse=True)
+    xs, ys = zip(*samples)
+    X_lengths = torch.tensor([x.shape[0] for x in xs])
+    Y_lengths = torch.tensor([y.shape[0] for y in ys])
+    X = pad_sequence(xs, batch_first=True, padding_value=padding_idx).long()
+    Y = pad_sequence(ys, batch_first=True, padding_value=padding_idx).long()
+    return X, Y, X_lengths, Y_lengths
@@ -1,4 +1,5 @@
 import argparse
+import os
 import random
 from functools import partial
 from os.path import join
@@ -11,7 +12,9 @@ from torch.utils.data import DataLoader
 
 import matplotlib.pyplot as plt
 
-from data import collate_samples, Seq2SeqDataset, PAD_IDX, SOS_IDX, EOS_IDX
+import checkpointing
+import instrumentation
+from data import collate_samples, collate_with_lengths, BucketBatchSampler, Seq2SeqDataset, PAD_IDX, SOS_IDX, EOS_IDX
 from models import Encoder, Decoder, Seq2Seq, BahdanauAttention, reshape_state
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -27,26 +30,73 @@ def configure_seed(seed):
 
 
 def distance(str1, str2):
-    """Simple Levenshtein implementation for evalm."""
-    m = np.zeros([len(str2) + 1, len(str1) + 1], dtype=int)
-    for x in range(1, len(str2) + 1):
-        m[x, 0] = m[x - 1, 0] + 1
-    for y in range(1, len(str1) + 1):
-        m[0, y] = m[0, y - 1] + 1
-    for x in range(1, len(str2) + 1):
-        for y in range(1, len(str1) + 1):
-            if str1[y - 1] == str2[x - 1]:
-                dg = 0
-            else:
-                dg = 1
-            m[x, y] = min(
-                m[x - 1, y] + 1, m[x, y - 1] + 1, m[x - 1, y - 1] + dg
-            )
-    return m[len(str2), len(str1)]
+    """
+    Levenshtein distance between str1 and str2, computed with the
+    bit-parallel algorithm of Myers (1999), in Hyyro's formulation for
+    edit distance: one DP column is kept as the bits of two Python ints
+    (vertical +1 / -1 deltas), so every character of str2 costs a handful
+    of integer operations instead of a loop over str1.
+    """
+    m = len(str1)
+    if m == 0:
+        return len(str2)
+
+    # peq[c]: bit i is set when str1[i] == c
+    peq = {}
+    for i, c in enumerate(str1):
+        peq[c] = peq.get(c, 0) | (1 << i)
+
+    full = (1 << m) - 1
+    last = 1 << (m - 1)
+    pv = full  # positive vertical deltas: column 0 is 0, 1, ..., m
+    mv = 0  # negative vertical deltas
+    score = m
+    for c in str2:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & full)
+        mh = pv & xh
+        if ph & last:
+            score += 1
+        elif mh & last:
+            score -= 1
+        # the first row of the DP matrix grows by one per character of str2
+        ph = ((ph << 1) | 1) & full
+        mh = (mh << 1) & full
+        pv = mh | (~(xv | ph) & full)
+        mv = ph & xv
+    return score
+
+
+def batch_distance(golds, preds):
+    """Levenshtein distances of every (gold, pred) pair, as an int array."""
+    return np.fromiter(
+        (distance(gold, pred) for gold, pred in zip(golds, preds)),
+        dtype=int,
+        count=min(len(golds), len(preds)),
+    )
 
 
-def train(data, model, lr, n_epochs, checkpoint_name, max_len=50):
+def train(data, model, lr, n_epochs, checkpoint_name, max_len=50, logger=None,
+          sorted_batches=False, packed=False, checkpoint_every=1, resume=False):
+    """
+    data: (train_iter, val_iter, test_iter); train_iter yields batches from
+        collate_with_lengths
+    logger: instrumentation.EpochLogger receiving per-epoch timings (data,
+        forward, backward, optimizer, evaluation) and validation metrics
+    sorted_batches: training batches are sorted by decreasing source length
+        (collate_with_lengths(..., sort=True)), so packing can skip sorting
+    packed: also run the teacher-forced decoder on packed sequences, so its
+        LSTM skips the target padding
+    checkpoint_every: save the full training state (model, optimizer, RNG
+        states, validation history) every this many epochs to
+        checkpoint_name with a "-last" suffix, on a background thread
+    resume: continue from that checkpoint, if there is one
+    """
     model.train()
+    if logger is None:
+        logger = instrumentation.EpochLogger(os.devnull)
 
     train_iter, val_iter, test_iter = data
 
@@ -59,49 +109,103 @@ def train(data, model, lr, n_epochs, checkpoint_name, max_len=50):
     val_err_rates = []
     min_err_rate = float("inf")
 
-    # Training the model
-    for epoch in range(n_epochs):
-        model.train()
-        for src, tgt in train_iter:
-            src_lengths = (src != PAD_IDX).sum(1)
-            src, tgt = src.to(device), tgt.to(device)
-            src_lengths = src_lengths.to(device)
+    checkpointer = checkpointing.AsyncCheckpointer(checkpointing.default_path(checkpoint_name))
+    start_epoch = 0
+    if resume and os.path.exists(checkpointer.path):
+        state = checkpointer.load()
+        model.load_state_dict(state["model"])
+        optimizer.load_state_dict(state["optimizer"])
+        checkpointing.set_rng_state(state["rng"])
+        val_err_rates = state["history"]["val_err_rates"]
+        min_err_rate = state["history"]["min_err_rate"]
+        start_epoch = state["epoch"]
+        print("Resuming after epoch %d from %s" % (start_epoch, checkpointer.path))
 
-            optimizer.zero_grad()
-            outputs, _ = model(src, src_lengths, tgt)
-            loss = criterion(
-                outputs.reshape(-1, outputs.shape[-1]), tgt[:, 1:].reshape(-1)
+    # Training the model
+    try:
+        for epoch in range(start_epoch, n_epochs):
+            model.train()
+            logger.start_epoch(epoch + 1)
+            # real vs padded token counts, for the padding efficiency of the epoch
+            real_tokens = 0
+            padded_tokens = 0
+            for src, tgt, src_lengths, tgt_lengths in logger.timed(train_iter):
+                with logger.phase("data"):
+                    batch_tokens = src_lengths.sum().item() + tgt_lengths.sum().item()
+                    real_tokens += batch_tokens
+                    padded_tokens += src.numel() + tgt.numel()
+                    src, tgt = src.to(device), tgt.to(device)
+                    src_lengths = src_lengths.to(device)
+
+                with logger.phase("forward"):
+                    optimizer.zero_grad()
+                    outputs, _ = model(
+                        src, src_lengths, tgt, enforce_sorted=sorted_batches,
+                        tgt_lengths=tgt_lengths if packed else None,
+                    )
+                    loss = criterion(
+                        outputs.reshape(-1, outputs.shape[-1]), tgt[:, 1:].reshape(-1)
+                    )
+                with logger.phase("backward"):
+                    loss.backward()
+                with logger.phase("optimizer"):
+                    optimizer.step()
+                logger.add_examples(src.shape[0])
+                logger.add_tokens(batch_tokens)
+
+            padding_efficiency = real_tokens / padded_tokens
+            print("Epoch: [%d/%d], Loss: %.4f, Padding efficiency: %.4f" % (
+                epoch + 1, n_epochs, loss, padding_efficiency))
+
+            # validation is always greedy
+            with logger.phase("evaluation"):
+                val_err_rate, _ = test(model, val_iter, max_len=max_len)
+            print("Validation error rate: %.4f" % (val_err_rate))
+            logger.end_epoch(
+                loss=loss.item(), val_err_rate=val_err_rate, padding_efficiency=padding_efficiency
             )
-            loss.backward()
-            optimizer.step()
-
-        print("Epoch: [%d/%d], Loss: %.4f" % (epoch + 1, n_epochs, loss))
-
-        # validation is always greedy
-        val_err_rate, _ = test(model, val_iter, max_len=max_len)
-        print("Validation error rate: %.4f" % (val_err_rate))
-
-        if val_err_rate < min_err_rate:
-            min_err_rate = val_err_rate
-            print("New best error rate found: {:.4f}".format(min_err_rate))
-            print("Saving model")
-            torch.save(model.state_dict(), checkpoint_name)
-
-        val_err_rates.append(val_err_rate)
 
+            if val_err_rate < min_err_rate:
+                min_err_rate = val_err_rate
+                print("New best error rate found: {:.4f}".format(min_err_rate))
+                print("Saving model")
+                torch.save(model.state_dict(), checkpoint_name)
+
+            val_err_rates.append(val_err_rate)
+
+            if checkpoint_every > 0 and ((epoch + 1) % checkpoint_every == 0 or epoch + 1 == n_epochs):
+                checkpointer.save({
+                    "epoch": epoch + 1,
+                    "model": model.state_dict(),
+                    "optimizer": optimizer.state_dict(),
+                    "rng": checkpointing.rng_state(),
+                    "history": {"val_err_rates": val_err_rates, "min_err_rate": min_err_rate},
+                })
+    finally:
+        checkpointer.close()
     return min_err_rate, val_err_rates
 
 
-def generate(model, data_iter, max_len=50, p=None):
+def generate(
+    model, data_iter, max_len=50, p=None, beam_size=None, length_penalty=1.0,
+    generator=None, n_samples=1,
+):
     # Test the Model
-    assert data_iter.batch_size == 1
+    if beam_size is not None:
+        return beam_search(
+            model, data_iter, beam_size, max_len=max_len, length_penalty=length_penalty
+        )
+    if data_iter.batch_size > 1 or n_samples > 1:
+        return generate_batched(
+            model, data_iter, max_len=max_len, p=p, generator=generator, n_samples=n_samples
+        )
 
     model.eval()
 
     if p is None:
         next_token_func = greedy_next_token
     else:
-        next_token_func = partial(nucleus_sampling, p=p)
+        next_token_func = partial(nucleus_sampling, p=p, generator=generator)
 
     predictions = []
     with torch.no_grad():
@@ -126,11 +230,13 @@ def generate(model, data_iter, max_len=50, p=None):
             if dec_state[0].shape[0] == 2:
                 dec_state = reshape_state(dec_state)
 
+            attn_cache = model.decoder.init_attn_cache(encoder_outputs, src_lengths)
+
             for _ in range(max_len):
                 prev_token = predicted_sequence[-1]
 
                 output, dec_state = model.decoder(
-                    prev_token, dec_state, encoder_outputs, src_lengths
+                    prev_token, dec_state, encoder_outputs, src_lengths, attn_cache
                 )
                 logits = model.generator(output.view(-1))
 
@@ -142,10 +248,176 @@ def generate(model, data_iter, max_len=50, p=None):
                 if int(next_token) == EOS_IDX:
                     break
 
-            predicted_sequence = torch.cat(predicted_sequence).squeeze()
-            predictions.append(predicted_sequence)
+            predicted_sequence = torch.cat(predicted_sequence).view(-1)
+            predictions.append(predicted_sequence.cpu())
+
+    if not predictions:
+        return []
+    padded = nn.utils.rnn.pad_sequence(predictions, batch_first=True, padding_value=PAD_IDX)
+    return data_iter.dataset.tgt_vocab.decode_many(padded)
+
+
+def generate_batched(model, data_iter, max_len=50, p=None, generator=None, n_samples=1):
+    """
+    Same predictions as generate with batch_size=1, but each padded batch
+    of data_iter is encoded once and the decoder is stepped for all its
+    sequences together. Sequences that produced EOS are dropped from the
+    decoder batch, so finished rows cost nothing in later steps.
+
+    n_samples > 1 decodes every source that many times in the same batch
+    (useful with sampling) and returns the n_samples predictions of each
+    source consecutively.
+    """
+    model.eval()
+
+    if p is None:
+        next_token_func = greedy_next_token
+    else:
+        next_token_func = partial(nucleus_sampling, p=p, generator=generator)
 
-    return [data_iter.dataset.tgt_vocab.tensor2string(p) for p in predictions]
+    tgt_vocab = data_iter.dataset.tgt_vocab
+    predictions = []
+    with torch.no_grad():
+        for src, tgt in data_iter:
+            src_lengths = (src != PAD_IDX).sum(1)
+            src = src.to(device)
+            src_lengths = src_lengths.to(device)
+
+            encoder_outputs, final_enc_state = model.encoder(src, src_lengths)
+            dec_state = final_enc_state
+
+            if dec_state[0].shape[0] == 2:
+                dec_state = reshape_state(dec_state)
+
+            if n_samples > 1:
+                # the encoder runs once per source; its outputs are shared
+                encoder_outputs = encoder_outputs.repeat_interleave(n_samples, dim=0)
+                src_lengths = src_lengths.repeat_interleave(n_samples, dim=0)
+                dec_state = tuple(s.repeat_interleave(n_samples, dim=1) for s in dec_state)
+            batch_size = encoder_outputs.shape[0]
+
+            attn_cache = model.decoder.init_attn_cache(encoder_outputs, src_lengths)
+
+            # generated tokens, and how many of them belong to each sequence
+            sequences = torch.full(
+                [batch_size, max_len], PAD_IDX, dtype=torch.long, device=device
+            )
+            seq_lengths = torch.full([batch_size], max_len, dtype=torch.long, device=device)
+
+            # rows of the batch that have not produced EOS yet
+            active = torch.arange(batch_size, device=device)
+            prev_token = torch.full(
+                [batch_size, 1], SOS_IDX, dtype=torch.long, device=device
+            )
+            for step in range(max_len):
+                output, dec_state = model.decoder(
+                    prev_token, dec_state, encoder_outputs, src_lengths, attn_cache
+                )
+                logits = model.generator(output[:, -1])  # (n_active, vocab_size)
+                next_token = next_token_func(logits).view(-1, 1)
+                sequences[active, step] = next_token.view(-1)
+
+                # Stop symbol index
+                finished = next_token.view(-1) == EOS_IDX
+                if finished.any():
+                    seq_lengths[active[finished]] = step + 1
+                    keep = ~finished
+                    if not keep.any():
+                        break
+                    active = active[keep]
+                    next_token = next_token[keep]
+                    dec_state = tuple(s[:, keep] for s in dec_state)
+                    encoder_outputs = encoder_outputs[keep]
+                    src_lengths = src_lengths[keep]
+                    if attn_cache is not None:
+                        attn_cache = tuple(t[keep] for t in attn_cache)
+                prev_token = next_token
+
+            predictions.extend(tgt_vocab.decode_many(sequences, seq_lengths))
+
+    return predictions
+
+
+def beam_search(model, data_iter, beam_size, max_len=50, length_penalty=1.0):
+    """
+    Beam search decoding. The beam_size hypotheses of every sentence in a
+    batch are kept as rows of a single (batch_size * beam_size) decoder
+    batch; after each step the surviving hypotheses are gathered with
+    index_select on the decoder state and token history.
+
+    Hypotheses are ranked by total log-probability while searching; the
+    final choice divides it by length ** length_penalty (0 disables the
+    normalization).
+    """
+    model.eval()
+
+    tgt_vocab = data_iter.dataset.tgt_vocab
+    predictions = []
+    with torch.no_grad():
+        for src, tgt in data_iter:
+            src_lengths = (src != PAD_IDX).sum(1)
+            src = src.to(device)
+            src_lengths = src_lengths.to(device)
+            batch_size = src.shape[0]
+            n_rows = batch_size * beam_size
+
+            encoder_outputs, final_enc_state = model.encoder(src, src_lengths)
+            dec_state = final_enc_state
+
+            if dec_state[0].shape[0] == 2:
+                dec_state = reshape_state(dec_state)
+
+            # row b * beam_size + k holds hypothesis k of sentence b
+            encoder_outputs = encoder_outputs.repeat_interleave(beam_size, dim=0)
+            src_lengths = src_lengths.repeat_interleave(beam_size, dim=0)
+            dec_state = tuple(s.repeat_interleave(beam_size, dim=1) for s in dec_state)
+            # beams are only reordered within a sentence, so the encoder-side
+            # tensors and the attention cache never need to be gathered
+            attn_cache = model.decoder.init_attn_cache(encoder_outputs, src_lengths)
+
+            # all hypotheses start identical, so only the first one is expanded
+            scores = torch.full([batch_size, beam_size], float("-inf"), device=device)
+            scores[:, 0] = 0
+            sequences = torch.full([n_rows, max_len], PAD_IDX, dtype=torch.long, device=device)
+            seq_lengths = torch.zeros(n_rows, dtype=torch.long, device=device)
+            finished = torch.zeros(n_rows, dtype=torch.bool, device=device)
+            row_offsets = torch.arange(batch_size, device=device).unsqueeze(1) * beam_size
+
+            prev_token = torch.full([n_rows, 1], SOS_IDX, dtype=torch.long, device=device)
+            for step in range(max_len):
+                output, dec_state = model.decoder(
+                    prev_token, dec_state, encoder_outputs, src_lengths, attn_cache
+                )
+                log_probs = torch.log_softmax(model.generator(output[:, -1]), dim=-1)
+                vocab_size = log_probs.shape[-1]
+
+                # a finished hypothesis can only be continued by PAD, at no cost
+                log_probs[finished] = float("-inf")
+                log_probs[finished, PAD_IDX] = 0
+
+                candidates = (scores.view(-1, 1) + log_probs).view(batch_size, -1)
+                scores, best = candidates.topk(beam_size, dim=1)
+                next_token = best % vocab_size
+                rows = (row_offsets + best // vocab_size).view(-1)
+
+                dec_state = tuple(s.index_select(1, rows) for s in dec_state)
+                sequences = sequences.index_select(0, rows)
+                seq_lengths = seq_lengths.index_select(0, rows)
+                finished = finished.index_select(0, rows)
+
+                next_token = next_token.view(-1)
+                sequences[:, step] = next_token
+                seq_lengths += ~finished
+                finished |= next_token == EOS_IDX
+                if finished.all():
+                    break
+                prev_token = next_token.view(-1, 1)
+
+            normalized = scores / seq_lengths.view(batch_size, beam_size).float() ** length_penalty
+            chosen = row_offsets.view(-1) + normalized.argmax(dim=1)
+            predictions.extend(tgt_vocab.decode_many(sequences[chosen], seq_lengths[chosen]))
+
+    return predictions
 
 
 def evaluate(predictions, gold_data_iter):
@@ -154,47 +426,57 @@ def evaluate(predictions, gold_data_iter):
         - character error rate (the levenshtein distance normalized by the true length)
         - word error rate (rate of examples where the prediction does not exactly match the true target)
     """
-    gold_len = 0
-    total_distance = 0
-    incorrect = 0
-    for pred, (src, tgt) in zip(predictions, gold_data_iter.dataset.pairs):
-        tgt = "".join(tgt)
-
-        d_list = distance(tgt, pred)
-
-        total_distance += d_list
-        gold_len += len(tgt)
-        if tgt != pred:
-            incorrect += 1
+    golds = gold_data_iter.dataset.targets[:len(predictions)]
+    total_distance = batch_distance(golds, predictions).sum()
+    gold_len = sum(len(tgt) for tgt in golds)
+    incorrect = sum(tgt != pred for tgt, pred in zip(golds, predictions))
 
     cer = total_distance / gold_len
     wer = incorrect / len(predictions)
     return cer, wer
 
 
-def test(model, data_iter, max_len=50, p=None):
-    predictions = generate(model, data_iter, max_len=max_len, p=p)
+def test(model, data_iter, max_len=50, p=None, beam_size=None, length_penalty=1.0, generator=None):
+    predictions = generate(
+        model, data_iter, max_len=max_len, p=p,
+        beam_size=beam_size, length_penalty=length_penalty, generator=generator,
+    )
     cer, wer = evaluate(predictions, data_iter)
     return cer, wer
 
 
-def compute_wer_at_k(model, gold_data_iter, max_len=50, p=None, k=1, ex_to_print=10):
-    multipreds = []
+def compute_wer_at_k(
+    model, gold_data_iter, max_len=50, p=None, k=1, ex_to_print=10,
+    generator=None, one_pass=False,
+):
+    """
+    one_pass: draw the k samples of every source in a single decoding pass,
+    with each source repeated k times in the decoder batch, instead of
+    running generate k times
+    """
     true_targets = []
-    for i in range(k):
-        predictions = generate(model, gold_data_iter, max_len=max_len, p=p)
-        multipreds.append(predictions)
-    pred_sets = [set(p) for p in zip(*multipreds)]
+    if one_pass:
+        predictions = generate(
+            model, gold_data_iter, max_len=max_len, p=p, generator=generator, n_samples=k
+        )
+        pred_sets = [set(predictions[i:i + k]) for i in range(0, len(predictions), k)]
+    else:
+        multipreds = []
+        for i in range(k):
+            predictions = generate(
+                model, gold_data_iter, max_len=max_len, p=p, generator=generator
+            )
+            multipreds.append(predictions)
+        pred_sets = [set(p) for p in zip(*multipreds)]
 
     incorrect = 0
-    for pred_set, (src, tgt) in zip(pred_sets, gold_data_iter.dataset.pairs):
-        tgt = "".join(tgt)
+    for pred_set, tgt in zip(pred_sets, gold_data_iter.dataset.targets):
         true_targets.append(tgt)
 
         if tgt not in pred_set:
             incorrect += 1
 
-    wer_at_k = incorrect / len(predictions)
+    wer_at_k = incorrect / len(pred_sets)
     examples = [(t, p) for t, p in zip(true_targets, pred_sets) if len(p) > 1]
     if ex_to_print > 0:
         print(f"Printing first {ex_to_print} examples with multiple predictions:")
@@ -206,22 +488,28 @@ def compute_wer_at_k(model, gold_data_iter, max_len=50, p=None, k=1, ex_to_print
 def greedy_next_token(logits):
     """
     Performs greedy decoding.
-    logits: 1d tensor of unnormalized scores for each class. Shape: (vocab_size,)
+    logits: tensor of unnormalized scores for each class. Shape: (vocab_size,)
+        or (batch_size, vocab_size)
 
     Returns:
-        next_token: index of the next predicted token. Shape: (1,)
+        next_token: index of the next predicted token. Shape: (1,) or
+        (batch_size, 1)
     """
     return logits.argmax(-1, keepdim=True)
 
 
-def nucleus_sampling(logits, p=0.8):
+def nucleus_sampling(logits, p=0.8, generator=None):
     """
     Performs nucleus (top-p) sampling
-    logits: 1d tensor of unnormalized scores for each class. Shape: (vocab_size,)
+    logits: tensor of unnormalized scores for each class. Shape: (vocab_size,)
+        or (batch_size, vocab_size), each row being sampled independently
     p: Cumulative probability threshold to be used. (scalar)
+    generator: optional torch.Generator (on the device of logits) to draw
+        from, so sampling is reproducible independently of the global seed
 
     Returns:
-        next_token: index of the next predicted token. Shape: (1,)
+        next_token: index of the next predicted token. Shape: (1,) or
+        (batch_size, 1)
     """
     # TODO: Top-p (nucleus) sampling  (https://arxiv.org/pdf/1904.09751 - Section 3.1)
     # You are asked to implement the following steps:
@@ -230,8 +518,24 @@ def nucleus_sampling(logits, p=0.8):
     # This is equivalent to selecting the tokens with highest probabilities, whose cumulative probability mass equals or exceeds p.
     # 3. Rescale the distribution and sample from the resulting set of tokens.
     # Implementation of the steps as described above:
+    single = logits.dim() == 1
+    if single:
+        logits = logits.unsqueeze(0)
 
-    raise NotImplementedError("Add your implementation.")
+    probs = torch.softmax(logits, dim=-1)
+    sorted_probs, sorted_ix = probs.sort(dim=-1, descending=True)
+
+    # a token is kept if the mass of the more probable tokens is still < p
+    mass_before = sorted_probs.cumsum(dim=-1) - sorted_probs
+    sorted_probs = sorted_probs.masked_fill(mass_before >= p, 0.0)
+    sorted_probs = sorted_probs / sorted_probs.sum(dim=-1, keepdim=True)
+
+    choice = torch.multinomial(sorted_probs, 1, generator=generator)
+    next_token = sorted_ix.gather(-1, choice)  # (batch_size, 1)
+
+    if single:
+        return next_token.view(1)
+    return next_token
 
 
 def main(args):
@@ -239,28 +543,44 @@ def main(args):
     configure_seed(args.seed)
 
     print("Loading data...")
-    train_dataset = Seq2SeqDataset(join(args.data_dir, "train.tsv"))
+    train_dataset = Seq2SeqDataset(join(args.data_dir, "train.tsv"), cache=args.cache_data)
     valid_dataset = Seq2SeqDataset(
         join(args.data_dir, "valid.tsv"),
         src_vocab=train_dataset.src_vocab,
-        tgt_vocab=train_dataset.tgt_vocab
+        tgt_vocab=train_dataset.tgt_vocab,
+        cache=args.cache_data,
     )
     test_dataset = Seq2SeqDataset(
         join(args.data_dir, "test.tsv"),
         src_vocab=train_dataset.src_vocab,
-        tgt_vocab=train_dataset.tgt_vocab
+        tgt_vocab=train_dataset.tgt_vocab,
+        cache=args.cache_data,
     )
 
     collate_fn = partial(collate_samples, padding_idx=PAD_IDX)
+    train_collate_fn = partial(
+        collate_with_lengths, padding_idx=PAD_IDX, sort=args.sort_batches
+    )
 
-    train_iter = DataLoader(
-        train_dataset,
-        batch_size=args.batch_size,
-        shuffle=True,
-        collate_fn=collate_fn,
+    if args.bucket:
+        train_iter = DataLoader(
+            train_dataset,
+            batch_sampler=BucketBatchSampler(train_dataset, args.batch_size),
+            collate_fn=train_collate_fn,
+        )
+    else:
+        train_iter = DataLoader(
+            train_dataset,
+            batch_size=args.batch_size,
+            shuffle=True,
+            collate_fn=train_collate_fn,
+        )
+    val_iter = DataLoader(
+        valid_dataset, batch_size=args.eval_batch_size, shuffle=False, collate_fn=collate_fn
+    )
+    test_iter = DataLoader(
+        test_dataset, batch_size=args.eval_batch_size, shuffle=False, collate_fn=collate_fn
     )
-    val_iter = DataLoader(valid_dataset, batch_size=1, shuffle=False)
-    test_iter = DataLoader(test_dataset, batch_size=1, shuffle=False)
 
     data_iters = (train_iter, val_iter, test_iter)
 
@@ -298,13 +618,24 @@ def main(args):
 
     if args.mode == "train":
         print("Training...")
+        sync = torch.cuda.synchronize if device.type == "cuda" else None
+        logger = instrumentation.EpochLogger(
+            "attn_%s_timings.jsonl" % (str(args.use_attn),), sync=sync,
+            per_phase_sync=args.sync_phases, append=args.resume, **vars(args)
+        )
         min_val_err, val_errs = train(
             data_iters,
             model,
             args.lr,
             args.n_epochs,
-            checkpoint_name
+            checkpoint_name,
+            logger=logger,
+            sorted_batches=args.sort_batches,
+            packed=args.packed,
+            checkpoint_every=args.checkpoint_every,
+            resume=args.resume,
         )
+        logger.close()
 
         print("Best validation error rate: %.4f" % (min_val_err))
         plt.plot(np.arange(1, args.n_epochs + 1), val_errs, label="Validation Set")
@@ -323,11 +654,20 @@ def main(args):
 
         model.load_state_dict(torch.load(checkpoint_name, weights_only=True))
 
-        test_cer, test_wer = test(model, test_iter, p=args.topp)
+        # sampling draws from its own generator, seeded like the rest of the run
+        generator = torch.Generator(device=device).manual_seed(args.seed)
+        test_cer, test_wer = test(
+            model, test_iter, p=args.topp,
+            beam_size=args.beam_size, length_penalty=args.length_penalty,
+            generator=generator,
+        )
         print("Test CER: %.4f, Test WER: %.4f" % (test_cer, test_wer))
 
         if args.topp is not None:
-            test_wer_at_k = compute_wer_at_k(model, test_iter, p=args.topp, k=args.k)
+            test_wer_at_k = compute_wer_at_k(
+                model, test_iter, p=args.topp, k=args.k,
+                generator=generator, one_pass=args.one_pass_samples,
+            )
             print("Test WER@{}: {:.4f}".format(args.k, test_wer_at_k))
 
 
@@ -338,6 +678,21 @@ if __name__ == "__main__":
     parser.add_argument("--dropout", type=float, default=0.3)
     parser.add_argument("--n_epochs", type=int, default=20)
     parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--cache_data", action="store_true",
+                        help="cache the encoded corpus next to the TSV files and memory-map it")
+    parser.add_argument("--bucket", action="store_true",
+                        help="batch training examples of similar length together")
+    parser.add_argument("--sort_batches", action="store_true",
+                        help="sort training batches by source length, so packing can skip sorting")
+    parser.add_argument("--packed", action="store_true",
+                        help="run the teacher-forced decoder on packed sequences")
+    parser.add_argument("--sync_phases", action="store_true",
+                        help="on CUDA, wait for the device at the end of every timed "
+                             "phase, not only of every epoch")
+    parser.add_argument("--checkpoint_every", type=int, default=1,
+                        help="save the training state every this many epochs (0 to disable)")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue training from the last saved training state")
     parser.add_argument("--hidden_size", type=int, default=128)
     parser.add_argument("--seed", type=int, default=42)
     parser.add_argument("--use_attn", action="store_true")
@@ -346,5 +701,13 @@ if __name__ == "__main__":
     parser.add_argument("--topp", type=float, default=None)
     parser.add_argument("--k", type=int, default=3)
     parser.add_argument("--max_len", type=int, default=50)
+    parser.add_argument("--beam_size", type=int, default=None,
+                        help="decode the test set with beam search of this size")
+    parser.add_argument("--length_penalty", type=float, default=1.0,
+                        help="beam scores are divided by length ** length_penalty")
+    parser.add_argument("--one_pass_samples", action="store_true",
+                        help="draw the k samples of WER@k in one batched decoding pass")
+    parser.add_argument("--eval_batch_size", type=int, default=1,
+                        help="sentences decoded together during validation and test")
     args = parser.parse_args()
     main(args)
@@ -20,27 +20,60 @@ class BahdanauAttention(nn.Module):
 
     def __init__(self, hidden_size):
         super(BahdanauAttention, self).__init__()
-        
-        raise NotImplementedError("Add your implementation.")
+        self.hidden_size = hidden_size
+
+        self.W_h = nn.Linear(hidden_size, hidden_size, bias=False)
+        self.W_s = nn.Linear(hidden_size, hidden_size, bias=False)
+        self.v = nn.Linear(hidden_size, 1, bias=False)
+        # combines the context vector with the decoder state
+        self.W_out = nn.Linear(2 * hidden_size, hidden_size)
+
+    def precompute(self, encoder_outputs, src_lengths):
+        """
+        Encoder-side part of the attention, which is the same for every
+        decoding step over a source batch.
+        Returns:
+            keys:       (batch_size, max_src_len, hidden_size) - W_h h_i
+            mask:       (batch_size, max_src_len) - True for valid positions
+        """
+        keys = self.W_h(encoder_outputs)
+        mask = self.sequence_mask(src_lengths, encoder_outputs.shape[1])
+        return keys, mask
 
-    def forward(self, query, encoder_outputs, src_lengths):
+    def forward(self, query, encoder_outputs, src_lengths, cache=None):
         """
         query:          (batch_size, max_tgt_len, hidden_size)
         encoder_outputs:(batch_size, max_src_len, hidden_size)
         src_lengths:    (batch_size)
+        cache:          optional result of precompute for these encoder_outputs,
+                        so incremental decoding only projects the new query
         Returns:
             attn_out:   (batch_size, max_tgt_len, hidden_size) - attended vector
         """
+        if cache is None:
+            cache = self.precompute(encoder_outputs, src_lengths)
+        keys, mask = cache
 
-        raise NotImplementedError("Add your implementation.")
+        # (batch_size, max_tgt_len, max_src_len, hidden_size)
+        features = torch.tanh(keys.unsqueeze(1) + self.W_s(query).unsqueeze(2))
+        scores = self.v(features).squeeze(-1)  # (batch_size, max_tgt_len, max_src_len)
 
-    def sequence_mask(self, lengths):
+        scores = scores.masked_fill(~mask.unsqueeze(1), float("-inf"))
+        alignment = torch.softmax(scores, dim=-1)
+
+        context = torch.bmm(alignment, encoder_outputs)  # (batch_size, max_tgt_len, hidden_size)
+        attn_out = torch.tanh(self.W_out(torch.cat([context, query], dim=-1)))
+        return attn_out
+
+    def sequence_mask(self, lengths, max_len=None):
         """
         Creates a boolean mask from sequence lengths.
         True for valid positions, False for padding.
+        max_len defaults to the longest length.
         """
         batch_size = lengths.numel()
-        max_len = lengths.max()
+        if max_len is None:
+            max_len = lengths.max()
         return (torch.arange(max_len, device=lengths.device)
                 .unsqueeze(0)
                 .repeat(batch_size, 1)
@@ -76,9 +109,11 @@ class Encoder(nn.Module):
         self,
         src,
         lengths,
+        enforce_sorted=False,
     ):
         # src: (batch_size, max_src_len)
         # lengths: (batch_size)
+        # enforce_sorted: lengths are in decreasing order, no need to sort
         #############################################
         # TODO: Implement the forward pass of the encoder
         # Hints:
@@ -87,15 +122,13 @@ class Encoder(nn.Module):
         # - Use torch.nn.utils.rnn.pad_packed_sequence to unpack the packed sequences
         #   (after passing them to the LSTM)
         #############################################
-        padded = self.embedding(src)
-        packed = pack(padded, lengths)
-        
-        passed, (h, c) = self.lstm(packed)
+        padded = self.dropout(self.embedding(src))
+        packed = pack(padded, lengths.cpu(), batch_first=True, enforce_sorted=enforce_sorted)
 
-        unpacked = unpack(passed)
-        final_state = reshape_state((h, c))
+        passed, final_hidden = self.lstm(packed)
 
-        return unpacked[0]
+        enc_output, _ = unpack(passed, batch_first=True, total_length=src.shape[1])
+        enc_output = self.dropout(enc_output)
 
         #############################################
         # END OF YOUR CODE
@@ -103,7 +136,7 @@ class Encoder(nn.Module):
         # enc_output: (batch_size, max_src_len, hidden_size)
         # final_hidden: tuple with 2 tensors
         # each tensor is (num_layers * num_directions, batch_size, hidden_size)
-        raise NotImplementedError("Add your implementation.")
+        return enc_output, final_hidden
 
 
 class Decoder(nn.Module):
@@ -139,12 +172,22 @@ class Decoder(nn.Module):
         dec_state,
         encoder_outputs,
         src_lengths,
+        attn_cache=None,
+        tgt_lengths=None,
+        teacher_forcing=False,
     ):
         # tgt: (batch_size, max_tgt_len)
         # dec_state: tuple with 2 tensors
         # each tensor is (num_layers * num_directions, batch_size, hidden_size)
         # encoder_outputs: (batch_size, max_src_len, hidden_size)
         # src_lengths: (batch_size)
+        # attn_cache: optional result of init_attn_cache, reused across the
+        # steps of incremental decoding
+        # tgt_lengths: optional (batch_size) lengths of tgt; the LSTM then
+        # runs on packed sequences, skipping padding
+        # teacher_forcing: tgt is a full target sequence ending in EOS, whose
+        # last token is then dropped from the inputs; otherwise every token
+        # of tgt (e.g. a generated prefix) is an input
         # bidirectional encoder outputs are concatenated, so we may need to
         # reshape the decoder states to be of size (num_layers, batch_size, 2*hidden_size)
         # if they are of size (num_layers*num_directions, batch_size, hidden_size)
@@ -166,7 +209,32 @@ class Decoder(nn.Module):
         #         src_lengths,
         #     )
         #############################################
-        
+        # with teacher forcing the last target token (EOS) is never an input
+        if teacher_forcing:
+            tgt = tgt[:, :-1]
+
+        embedded = self.dropout(self.embedding(tgt))
+
+        # the attention output is not fed back into the LSTM, so all
+        # positions can go through the LSTM (and the attention) at once
+        if tgt_lengths is not None:
+            # with teacher forcing the inputs of a sequence stop before its EOS
+            input_lengths = tgt_lengths - 1 if teacher_forcing else tgt_lengths
+            packed = pack(embedded, input_lengths.cpu(), batch_first=True, enforce_sorted=False)
+            outputs, dec_state = self.lstm(packed, dec_state)
+            outputs, _ = unpack(outputs, batch_first=True, total_length=tgt.shape[1])
+        else:
+            outputs, dec_state = self.lstm(embedded, dec_state)
+
+        if self.attn is not None:
+            outputs = self.attn(
+                outputs,
+                encoder_outputs,
+                src_lengths,
+                cache=attn_cache,
+            )
+
+        outputs = self.dropout(outputs)
 
         #############################################
         # END OF YOUR CODE
@@ -174,7 +242,18 @@ class Decoder(nn.Module):
         # outputs: (batch_size, max_tgt_len, hidden_size)
         # dec_state: tuple with 2 tensors
         # each tensor is (num_layers, batch_size, hidden_size)
-        raise NotImplementedError("Add your implementation.")
+        return outputs, dec_state
+
+
+    def init_attn_cache(self, encoder_outputs, src_lengths):
+        """
+        Precomputes the encoder-side attention tensors for step-by-step
+        decoding over one source batch (None without attention). The cache
+        is a tuple of tensors indexed by batch row, like encoder_outputs.
+        """
+        if self.attn is None:
+            return None
+        return self.attn.precompute(encoder_outputs, src_lengths)
 
 
 class Seq2Seq(nn.Module):
@@ -198,15 +277,18 @@ class Seq2Seq(nn.Module):
         src_lengths,
         tgt,
         dec_hidden=None,
+        enforce_sorted=False,
+        tgt_lengths=None,
     ):
 
-        encoder_outputs, final_enc_state = self.encoder(src, src_lengths)
+        encoder_outputs, final_enc_state = self.encoder(src, src_lengths, enforce_sorted)
 
         if dec_hidden is None:
             dec_hidden = final_enc_state
 
         output, dec_hidden = self.decoder(
-            tgt, dec_hidden, encoder_outputs, src_lengths
+            tgt, dec_hidden, encoder_outputs, src_lengths,
+            tgt_lengths=tgt_lengths, teacher_forcing=True,
         )
 
         return self.generator(output), dec_hidden
@@ -0,0 +1,166 @@
+import contextlib
+import json
+import resource
+import sys
+import time
+from collections import defaultdict
+
+
+# peak RSS before the last reset by track_peak_memory, in MB
+_peak_rss_before_reset = 0.0
+
+
+def _max_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    if sys.platform == "darwin":
+        return peak / 2 ** 20
+    return peak / 2 ** 10
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB."""
+    return max(_max_rss_mb(), _peak_rss_before_reset)
+
+
+def _reset_peak_rss():
+    """
+    Restart the peak RSS from the current RSS (Linux only); returns whether
+    it could be reset.
+    """
+    global _peak_rss_before_reset
+    peak = peak_rss_mb()
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    _peak_rss_before_reset = peak
+    return True
+
+
+@contextlib.contextmanager
+def track_peak_memory(device="cpu"):
+    """
+    Measure the memory used inside the with-block. Yields a dict filled in
+    when the block ends: "start_mb", the memory in use when the block
+    started, "peak_mb", the peak during the block, and "used_mb", the peak
+    above the start. On a CUDA device this is the memory allocated by
+    torch, otherwise the RSS of the process; where the peak RSS cannot be
+    reset, "start_mb" is the peak RSS so far and "used_mb" is how far the
+    block raised it. peak_rss_mb() is not affected.
+    """
+    stats = {"start_mb": 0.0, "peak_mb": 0.0, "used_mb": 0.0}
+    if str(device).startswith("cuda"):
+        import torch
+
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        stats["start_mb"] = torch.cuda.memory_allocated(device) / 2 ** 20
+        try:
+            yield stats
+        finally:
+            torch.cuda.synchronize(device)
+            stats["peak_mb"] = torch.cuda.max_memory_allocated(device) / 2 ** 20
+            stats["used_mb"] = stats["peak_mb"] - stats["start_mb"]
+        return
+    # right after a reset, the peak RSS is the current RSS
+    _reset_peak_rss()
+    stats["start_mb"] = _max_rss_mb()
+    try:
+        yield stats
+    finally:
+        stats["peak_mb"] = _max_rss_mb()
+        stats["used_mb"] = stats["peak_mb"] - stats["start_mb"]
+
+
+def no_phase(name):
+    """Stand-in for EpochLogger.phase when no logger is in use."""
+    return contextlib.nullcontext()
+
+
+class EpochLogger(object):
+    """
+    Records per-epoch wall time, time per phase (data loading, forward,
+    backward, optimizer step, evaluation, ...), examples/sec and peak RSS,
+    and appends one JSON object per epoch to a JSONL file.
+
+    Only perf_counter calls are added to the timed code. Work queued on an
+    accelerator is waited for with the sync callable (for example
+    torch.cuda.synchronize), if one is given, only when the epoch ends: the
+    epoch time is exact, and each phase is charged for the queued work it
+    waits on. per_phase_sync=True also syncs at the end of every phase, for
+    exact phase times at the cost of the overlap between host and device
+    (such as prefetched copies). append=True adds to an existing log (for a
+    resumed run) instead of starting a new one.
+    """
+
+    def __init__(self, path, sync=None, per_phase_sync=False, append=False, **run_info):
+        self.path = path
+        self.sync = sync
+        self.per_phase_sync = per_phase_sync
+        self.file = open(path, "a" if append else "w")
+        self.epoch = None
+        self._write({"run": run_info})
+
+    def _write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def start_epoch(self, epoch):
+        self.epoch = epoch
+        self.phases = defaultdict(float)
+        self.examples = 0
+        self.tokens = 0
+        self.epoch_start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.per_phase_sync and self.sync is not None:
+                self.sync()
+            self.phases[name] += time.perf_counter() - start
+
+    def timed(self, batches, name="data"):
+        """Iterate over batches, charging the time spent in next() to name."""
+        batches = iter(batches)
+        while True:
+            with self.phase(name):
+                try:
+                    batch = next(batches)
+                except StopIteration:
+                    return
+            yield batch
+
+    def add_examples(self, n):
+        self.examples += int(n)
+
+    def add_tokens(self, n):
+        """Count tokens, for models whose examples vary in length."""
+        self.tokens += int(n)
+
+    def end_epoch(self, **metrics):
+        """Write the record of the current epoch; metrics are added to it."""
+        if self.sync is not None:
+            self.sync()
+        elapsed = time.perf_counter() - self.epoch_start
+        record = {
+            "epoch": int(self.epoch),
+            "time": elapsed,
+            "phases": dict(self.phases),
+            "examples": self.examples,
+            "examples_per_sec": self.examples / elapsed if elapsed > 0 else 0.0,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+        if self.tokens:
+            record["tokens"] = self.tokens
+            record["tokens_per_sec"] = self.tokens / elapsed if elapsed > 0 else 0.0
+        record.update({k: float(v) for k, v in metrics.items()})
+        self._write(record)
+        return record
+
+    def close(self):
+        self.file.close()
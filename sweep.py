@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+# Hyperparameter sweeps over the training scripts (hw1-q2.py, hw2-q2.py)
+
+import argparse
+import contextlib
+import csv
+import importlib.util
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import time
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+
+# options that select the dataset, which is loaded once for the whole sweep
+DATA_OPTIONS = ('data_path', 'lazy_data')
+
+
+def load_script(path):
+    """
+    Import a training script by path (names like hw1-q2.py cannot be
+    imported directly). The script must define build_parser(),
+    load_data(opt) and run(opt, dataset) -> dict of metrics.
+    """
+    path = os.path.abspath(path)
+    # the script imports its own utils and instrumentation
+    if os.path.dirname(path) not in sys.path:
+        sys.path.insert(0, os.path.dirname(path))
+    name = os.path.splitext(os.path.basename(path))[0].replace('-', '_')
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def sample(param, rng):
+    """One draw of a random search parameter."""
+    if isinstance(param, list):
+        return rng.choice(param)
+    if 'uniform' in param:
+        low, high = param['uniform']
+        if isinstance(low, int) and isinstance(high, int):
+            return rng.randint(low, high)
+        return rng.uniform(low, high)
+    if 'log_uniform' in param:
+        low, high = param['log_uniform']
+        return math.exp(rng.uniform(math.log(low), math.log(high)))
+    raise ValueError('Unknown random search parameter: {}'.format(param))
+
+
+def expand_spec(spec):
+    """
+    The trials of a sweep spec, as a list of {option: value} dicts.
+
+    spec["grid"] maps options to lists of values, and every combination is
+    a trial. spec["random"] = {"trials": n, "seed": s, "params": {...}}
+    draws n trials, each parameter being a list of choices or
+    {"uniform": [low, high]} / {"log_uniform": [low, high]}. Given both,
+    every grid point is combined with every random draw.
+    """
+    grid = spec.get('grid', {})
+    names = list(grid)
+    grid_trials = [dict(zip(names, values)) for values in itertools.product(*grid.values())]
+
+    random_trials = [{}]
+    if 'random' in spec:
+        rng = random.Random(spec['random'].get('seed', 0))
+        params = spec['random']['params']
+        random_trials = [
+            {name: sample(param, rng) for name, param in params.items()}
+            for _ in range(spec['random']['trials'])
+        ]
+    return [dict(g, **r) for g in grid_trials for r in random_trials]
+
+
+def trial_args(base_args, params):
+    """Command line of a trial: base_args followed by its options."""
+    args = list(base_args)
+    for name, value in params.items():
+        if value is True:
+            args.append('-' + name)
+        elif value is not False:
+            args += ['-' + name, str(value)]
+    return args
+
+
+# state of a worker process, set once by _init_worker
+_worker = {}
+
+
+def _init_worker(script_path, dataset, n_threads):
+    torch.set_num_threads(n_threads)
+    _worker['script'] = load_script(script_path)
+    _worker['dataset'] = dataset
+
+
+def _run_trial(task):
+    index, args, trial_dir = task
+    script = _worker['script']
+    opt = script.build_parser().parse_args(args)
+    start = time.time()
+    # the plots, timing logs and checkpoints of run() are named after only
+    # some of the options, so each trial writes them in its own directory
+    os.makedirs(trial_dir, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(trial_dir)
+    try:
+        with open('trial.log', 'w') as log, contextlib.redirect_stdout(log):
+            try:
+                results = script.run(opt, _worker['dataset'])
+            except Exception:
+                traceback.print_exc(file=log)
+                results = {'error': traceback.format_exc(limit=0).strip()}
+    finally:
+        os.chdir(cwd)
+    results['time'] = time.time() - start
+    return index, results
+
+
+def write_table(path, trials, results):
+    """One row per trial: its options, then its metrics."""
+    param_names = list(dict.fromkeys(name for params in trials for name in params))
+    metric_names = list(dict.fromkeys(name for r in results for name in r))
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['trial'] + param_names + metric_names)
+        for index, (params, r) in enumerate(zip(trials, results)):
+            writer.writerow(
+                [index]
+                + [params.get(name, '') for name in param_names]
+                + [r.get(name, '') for name in metric_names]
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('script',
+                        help="""Training script defining build_parser, load_data
+                        and run, e.g. hw1-q2.py or hw2-q2.py.""")
+    parser.add_argument('spec',
+                        help="""JSON file with the fixed command line of the
+                        script ("args") and a "grid" and/or "random" search
+                        over its options.""")
+    parser.add_argument('-workers', type=int, default=2)
+    parser.add_argument('-threads', type=int, default=None,
+                        help="""Torch threads per worker (default: the
+                        available cores divided among the workers).""")
+    parser.add_argument('-output', default='sweep-results.csv')
+    parser.add_argument('-log_dir', default='sweep-logs',
+                        help="""Where each trial gets a directory (trial-N) for
+                        its output, plots, timing log and checkpoints.""")
+    opt = parser.parse_args()
+
+    with open(opt.spec) as f:
+        spec = json.load(f)
+    trials = expand_spec(spec)
+    swept = {name for params in trials for name in params}
+    if swept & set(DATA_OPTIONS):
+        raise ValueError('The dataset options {} cannot be swept'.format(DATA_OPTIONS))
+
+    script = load_script(opt.script)
+    script_parser = script.build_parser()
+    # parse every trial up front, so a bad spec fails before any training
+    trial_opts = [script_parser.parse_args(trial_args(spec.get('args', []), params))
+                  for params in trials]
+
+    start = time.time()
+    dataset = script.load_data(trial_opts[0]).share_memory()
+    print('Loaded the dataset in {:.1f}s'.format(time.time() - start))
+
+    if hasattr(os, 'sched_getaffinity'):
+        n_cores = len(os.sched_getaffinity(0))
+    else:
+        n_cores = os.cpu_count() or 1
+    n_threads = opt.threads or max(1, n_cores // opt.workers)
+    print('{} trials, {} workers x {} threads'.format(len(trials), opt.workers, n_threads))
+
+    os.makedirs(opt.log_dir, exist_ok=True)
+    tasks = [
+        (index, trial_args(spec.get('args', []), params),
+         os.path.abspath(os.path.join(opt.log_dir, 'trial-{}'.format(index))))
+        for index, params in enumerate(trials)
+    ]
+    results = [None] * len(trials)
+    # spawned workers receive the shared-memory tensors of the dataset as
+    # handles, and do not inherit the threads of this process
+    ctx = mp.get_context('spawn')
+    with ctx.Pool(opt.workers, initializer=_init_worker,
+                  initargs=(os.path.abspath(opt.script), dataset, n_threads)) as pool:
+        for index, trial_results in pool.imap_unordered(_run_trial, tasks):
+            results[index] = trial_results
+            print('trial {} {} -> {}'.format(index, trials[index], trial_results))
+
+    write_table(opt.output, trials, results)
+    print('Sweep took {:.1f}s, results in {}'.format(time.time() - start, opt.output))
+
+
+if __name__ == '__main__':
+    main()
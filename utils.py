@@ -1,5 +1,10 @@
+import contextlib
 import os
+import queue
 import random
+import threading
+import time
+import tracemalloc
 
 import numpy as np
 import torch
@@ -14,7 +19,160 @@ def configure_seed(seed):
         torch.backends.cudnn.deterministic = True
         torch.backends.cudnn.benchmark = False
 
-def load_dataset(data_path, bias=False):
+@contextlib.contextmanager
+def track_allocations():
+    """
+    Measure heap allocations made inside the with-block using tracemalloc
+    (NumPy reports its array buffers to it). Yields a dict whose "peak_bytes"
+    (largest amount allocated above the starting point), "net_bytes" and
+    "net_blocks" (still allocated at exit) are filled in when the block ends.
+    Updates wrapped with traced_step inside the block also count their
+    "steps" and "allocating_steps" in it.
+    """
+    stats = {"peak_bytes": 0, "net_bytes": 0, "net_blocks": 0,
+             "steps": 0, "allocating_steps": 0}
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    start_blocks = _traced_blocks()
+    start, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    stats["_peak"] = 0
+    try:
+        yield stats
+    finally:
+        current, peak = tracemalloc.get_traced_memory()
+        # traced_step resets the peak at every step and keeps the largest
+        stats["peak_bytes"] = max(peak, stats.pop("_peak")) - start
+        stats["net_bytes"] = current - start
+        stats["net_blocks"] = _traced_blocks() - start_blocks
+        if not was_tracing:
+            tracemalloc.stop()
+
+
+def _traced_blocks():
+    """Number of memory blocks currently traced by tracemalloc."""
+    return sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+
+
+def traced_step(update, stats):
+    """
+    Wrap update (one training step) so that each call is counted in the
+    stats of the enclosing track_allocations block: "steps", and
+    "allocating_steps", the steps during which the traced memory rose above
+    its level at the start of the step. Unlike peak and net bytes, this
+    also catches a temporary allocated and freed within the step.
+    """
+    def step(*args, **kwargs):
+        # reading the traced memory creates a few objects; the first read
+        # measures their size, so they are not taken for the step's own
+        before = tracemalloc.get_traced_memory()
+        start = tracemalloc.get_traced_memory()
+        stats["_peak"] = max(stats["_peak"], start[1])
+        tracemalloc.reset_peak()
+        result = update(*args, **kwargs)
+        end = tracemalloc.get_traced_memory()
+        stats["_peak"] = max(stats["_peak"], end[1])
+        stats["steps"] += 1
+        if end[1] - start[0] > start[0] - before[0]:
+            stats["allocating_steps"] += 1
+        return result
+    return step
+
+SPLITS = {"train": "train", "dev": "val", "test": "test"}
+
+
+class LazyImageArray(object):
+    """
+    Read-only (n_examples x n_features) view over a uint8 image matrix,
+    usually a np.memmap of the dataset cache. Rows are divided by 256 (and
+    get the bias column appended) only when they are indexed, so a training
+    step holds one normalized block instead of the whole split in floats.
+    """
+
+    ndim = 2
+
+    def __init__(self, raw, bias=False, dtype=np.float64, order=None):
+        self.raw = raw
+        self.bias = bias
+        self.dtype = np.dtype(dtype)
+        self.order = order
+
+    @property
+    def shape(self):
+        n_rows = self.raw.shape[0] if self.order is None else self.order.shape[0]
+        return (n_rows, self.raw.shape[1] + int(self.bias))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def permute(self, order):
+        """Same rows as self[order], without reading or normalizing them."""
+        if self.order is not None:
+            order = self.order[order]
+        return LazyImageArray(self.raw, bias=self.bias, dtype=self.dtype, order=order)
+
+    def __getitem__(self, idx):
+        rows = idx if self.order is None else self.order[idx]
+        block = np.asarray(self.raw[rows])
+        n_feats = self.raw.shape[1]
+        out = np.empty(block.shape[:-1] + (n_feats + int(self.bias),), dtype=self.dtype)
+        np.divide(block, 256.0, out=out[..., :n_feats])
+        if self.bias:
+            out[..., n_feats] = 1
+        return out
+
+    def __iter__(self):
+        # normalize a block at a time rather than one row per read
+        for start in range(0, len(self), 1024):
+            yield from self[start:start + 1024]
+
+    def __array__(self, dtype=None, copy=None):
+        X = self[:]
+        return X if dtype is None else X.astype(dtype, copy=False)
+
+
+def cache_dataset(data_path, cache_dir=None):
+    """
+    Write every split of the npz at data_path as uncompressed .npy files
+    (images flattened to (n_examples x n_features) uint8, labels squeezed)
+    so they can be memory-mapped. The cache is rebuilt only when the npz is
+    newer than it. Returns the cache directory.
+    """
+    if cache_dir is None:
+        cache_dir = data_path + ".cache"
+    marker = os.path.join(cache_dir, "complete")
+    if os.path.exists(marker) and os.path.getmtime(marker) >= os.path.getmtime(data_path):
+        return cache_dir
+
+    os.makedirs(cache_dir, exist_ok=True)
+    data = np.load(data_path)
+    for name in SPLITS.values():
+        images = data[f"{name}_images"]
+        np.save(os.path.join(cache_dir, f"{name}_images.npy"),
+                images.reshape([images.shape[0], -1]))
+        np.save(os.path.join(cache_dir, f"{name}_labels.npy"),
+                np.asarray(data[f"{name}_labels"]).squeeze())
+    open(marker, "w").close()
+    return cache_dir
+
+
+def load_dataset(data_path, bias=False, lazy=False, dtype=np.float64):
+    """
+    lazy: memory-map (copy-on-write) the uint8 cache written by
+    cache_dataset and return LazyImageArray inputs that normalize on
+    indexing, instead of decoding and normalizing every split up front
+    dtype: floating point type of the normalized inputs
+    """
+    if lazy:
+        cache_dir = cache_dataset(data_path)
+        splits = {}
+        for split, name in SPLITS.items():
+            X = np.load(os.path.join(cache_dir, f"{name}_images.npy"), mmap_mode="c")
+            y = np.load(os.path.join(cache_dir, f"{name}_labels.npy"))
+            splits[split] = (LazyImageArray(X, bias=bias, dtype=dtype), y)
+        return splits
+
     data = np.load(data_path)
 
     train_X = data["train_images"].reshape([data["train_images"].shape[0], -1])/256
@@ -30,6 +188,11 @@ def load_dataset(data_path, bias=False):
         dev_X = np.hstack((dev_X, np.ones((dev_X.shape[0], 1))))
         test_X = np.hstack((test_X, np.ones((test_X.shape[0], 1))))
 
+    if np.dtype(dtype) != np.float64:
+        train_X = train_X.astype(dtype)
+        dev_X = dev_X.astype(dtype)
+        test_X = test_X.astype(dtype)
+
     return {
         "train": (train_X, train_y), "dev": (dev_X, dev_y), "test": (test_X, test_y),
     }
@@ -44,17 +207,325 @@ class ClassificationDataset(torch.utils.data.Dataset):
         dev_X, dev_y = data["dev"]
         test_X, test_y = data["test"]
 
-        self.X = torch.tensor(train_X, dtype=torch.float32)
+        self.X = torch.tensor(np.asarray(train_X), dtype=torch.float32)
         self.y = torch.tensor(train_y, dtype=torch.long)
 
-        self.dev_X = torch.tensor(dev_X, dtype=torch.float32)
+        self.dev_X = torch.tensor(np.asarray(dev_X), dtype=torch.float32)
         self.dev_y = torch.tensor(dev_y, dtype=torch.long)
 
-        self.test_X = torch.tensor(test_X, dtype=torch.float32)
+        self.test_X = torch.tensor(np.asarray(test_X), dtype=torch.float32)
         self.test_y = torch.tensor(test_y, dtype=torch.long)
 
+    def share_memory(self):
+        """
+        Move the tensors to shared memory, so worker processes receive a
+        handle to them instead of a pickled copy of every split.
+        """
+        for name in ("X", "y", "dev_X", "dev_y", "test_X", "test_y"):
+            getattr(self, name).share_memory_()
+        return self
+
     def __len__(self):
         return len(self.X)
 
     def __getitem__(self, idx):
         return self.X[idx], self.y[idx]
+
+    @property
+    def n_features(self):
+        return self.X.shape[1]
+
+
+class LazyClassificationDataset(torch.utils.data.Dataset):
+    """
+    Same interface as ClassificationDataset, but the tensors share memory
+    with the arrays in data instead of copying them. uint8 images from
+    load_dataset(lazy=True) are wrapped with torch.from_numpy and divided by
+    256 when indexed; float arrays are wrapped as they are and cast to
+    float32 per access (a no-op for float32 input).
+    """
+
+    def __init__(self, data):
+        """
+        data: the dict returned by utils.load_dataset
+        """
+        train_X, train_y = data["train"]
+        dev_X, dev_y = data["dev"]
+        test_X, test_y = data["test"]
+
+        self.raw_X, self.scale = self._wrap_inputs(train_X)
+        self.y = torch.as_tensor(np.asarray(train_y), dtype=torch.long)
+
+        self.raw_dev_X, _ = self._wrap_inputs(dev_X)
+        self.dev_y = torch.as_tensor(np.asarray(dev_y), dtype=torch.long)
+
+        self.raw_test_X, _ = self._wrap_inputs(test_X)
+        self.test_y = torch.as_tensor(np.asarray(test_y), dtype=torch.long)
+
+    @staticmethod
+    def _wrap_inputs(X):
+        if isinstance(X, LazyImageArray):
+            if X.bias or X.order is not None:
+                raise ValueError(
+                    "LazyClassificationDataset expects unpermuted inputs without a bias column")
+            return torch.from_numpy(X.raw), 1 / 256
+        return torch.from_numpy(np.asarray(X)), None
+
+    def normalize(self, raw):
+        X = raw.to(torch.float32)
+        if self.scale is not None:
+            X.mul_(self.scale)
+        return X
+
+    @property
+    def X(self):
+        # materializes the normalized training split; prefer indexing
+        return self.normalize(self.raw_X)
+
+    @property
+    def dev_X(self):
+        return self.normalize(self.raw_dev_X)
+
+    @property
+    def test_X(self):
+        return self.normalize(self.raw_test_X)
+
+    @property
+    def n_features(self):
+        return self.raw_X.shape[1]
+
+    def share_memory(self):
+        """
+        Move the raw tensors to shared memory, so DataLoader workers receive
+        a handle to them instead of a pickled copy of every split.
+        """
+        for name in ("raw_X", "y", "raw_dev_X", "dev_y", "raw_test_X", "test_y"):
+            getattr(self, name).share_memory_()
+        return self
+
+    def __len__(self):
+        return len(self.raw_X)
+
+    def __getitem__(self, idx):
+        return self.normalize(self.raw_X[idx]), self.y[idx]
+
+
+class BatchLoader(object):
+    """
+    Drop-in replacement for DataLoader(dataset, batch_size, shuffle) over a
+    dataset held in memory. Each batch is built with a single index-select
+    (dataset[indices]) instead of one __getitem__ per example followed by
+    default_collate. The shuffling draws the same permutation as
+    DataLoader's RandomSampler, so a seeded run sees the same batches.
+    """
+
+    def __init__(self, dataset, batch_size=1, shuffle=False, generator=None, drop_last=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.generator = generator
+        self.drop_last = drop_last
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def _order(self):
+        n = len(self.dataset)
+        # DataLoader draws its worker base seed before sampling; do the same
+        # so both consume the random stream identically
+        torch.empty((), dtype=torch.int64).random_(generator=self.generator)
+        if not self.shuffle:
+            return torch.arange(n)
+        generator = self.generator
+        if generator is None:
+            # same seeding as torch.utils.data.RandomSampler
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+            generator = torch.Generator()
+            generator.manual_seed(seed)
+        order = torch.randperm(n, generator=generator)
+        # RandomSampler also draws a (discarded) permutation for the
+        # num_samples % n remainder once it is exhausted
+        torch.randperm(n, generator=generator)
+        return order
+
+    def __iter__(self):
+        order = self._order()
+        for i in range(len(self)):
+            yield self.dataset[order[i * self.batch_size:(i + 1) * self.batch_size]]
+
+
+class Prefetcher(object):
+    """
+    Wraps a batch iterable (DataLoader, BatchLoader) and assembles the next
+    batches on a background thread, moving them to device, while the
+    current step runs. On CUDA the batches are pinned and copied with
+    non_blocking=True on a side stream, so the host-to-device copy overlaps
+    with compute. wait_time holds the seconds the last epoch spent blocked
+    waiting for a batch.
+    """
+
+    _done = object()
+
+    def __init__(self, loader, device, depth=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.wait_time = 0.0
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _stage(self, batch):
+        if self.stream is None:
+            return tuple(t.to(self.device) for t in batch), None
+        with torch.cuda.stream(self.stream):
+            staged = tuple(t.pin_memory().to(self.device, non_blocking=True) for t in batch)
+            ready = torch.cuda.Event()
+            ready.record(self.stream)
+        return staged, ready
+
+    @staticmethod
+    def _put(batches, item, stop):
+        # give up if the consumer stopped iterating, instead of blocking forever
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, batches, stop):
+        try:
+            for batch in self.loader:
+                if not self._put(batches, self._stage(batch), stop):
+                    return
+        except Exception as e:
+            self._put(batches, e, stop)
+            return
+        self._put(batches, self._done, stop)
+
+    def __iter__(self):
+        # the loader draws its shuffling seed in the worker before the first
+        # batch is queued, while this thread is blocked on get(), so seeded
+        # runs stay reproducible
+        self.wait_time = 0.0
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        worker = threading.Thread(target=self._produce, args=(batches, stop), daemon=True)
+        worker.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = batches.get()
+                self.wait_time += time.perf_counter() - start
+                if item is self._done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                batch, ready = item
+                if ready is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(ready)
+                    for t in batch:
+                        t.record_stream(current)
+                yield batch
+        finally:
+            stop.set()
+            worker.join()
+
+
+class EarlyStopping(object):
+    """
+    Follows a validation metric, keeps a copy of the model state with the
+    best value, and tells when patience evaluations in a row brought no
+    improvement (never, with patience=0).
+    """
+
+    def __init__(self, patience=0, mode="max"):
+        """mode: "max" for accuracies, "min" for losses"""
+        self.patience = patience
+        self.mode = mode
+        self.best = None
+        self.best_position = None
+        self.best_state = None
+        self.bad_evaluations = 0
+
+    def step(self, value, model, position):
+        """
+        Record the metric value of model at position (for example the
+        epoch); returns True when training should stop.
+        """
+        if self.best is None or (value > self.best if self.mode == "max" else value < self.best):
+            self.best = value
+            self.best_position = position
+            self.best_state = {k: v.detach().clone() for k, v in model.state_dict().items()}
+            self.bad_evaluations = 0
+        else:
+            self.bad_evaluations += 1
+        return self.should_stop
+
+    @property
+    def should_stop(self):
+        return self.patience > 0 and self.bad_evaluations >= self.patience
+
+    def state_dict(self):
+        return {"best": self.best, "best_position": self.best_position,
+                "best_state": self.best_state, "bad_evaluations": self.bad_evaluations}
+
+    def load_state_dict(self, state):
+        self.best = state["best"]
+        self.best_position = state["best_position"]
+        self.best_state = state["best_state"]
+        self.bad_evaluations = state["bad_evaluations"]
+
+
+def subsample(X, y, n, seed=0):
+    """
+    A fixed random subset of n examples of (X, y) (all of them if n is 0 or
+    larger than the set). Draws from its own generator, so the training
+    randomness is untouched.
+    """
+    if not n or n >= len(y):
+        return X, y
+    indices = torch.randperm(len(y), generator=torch.Generator().manual_seed(seed))[:n]
+    return X[indices], y[indices]
+
+
+def chunked_evaluate(score_fn, X, y, chunk_size, loss_fn=None):
+    """
+    Accuracy (and mean loss) of score_fn on X, scoring chunk_size examples
+    at a time so only one chunk of activations is alive at once (0: all at
+    once). Works on numpy arrays and torch tensors.
+
+    score_fn(X_chunk) -> scores (chunk_size x n_classes), or
+    (n_models x chunk_size x n_classes) for several models at once
+    loss_fn(scores, y_chunk) -> mean loss of the chunk (one per model);
+    chunks are weighted by their size, so the result is the mean over all
+    the examples.
+    Returns (accuracy, loss), loss being None without loss_fn; each is a
+    list with one value per model when the scores have a model dimension.
+    """
+    n_examples = y.shape[0]
+    chunk_size = chunk_size or n_examples
+    n_correct = 0
+    loss_sum = 0.0
+    for start in range(0, n_examples, chunk_size):
+        end = start + chunk_size
+        scores = score_fn(X[start:end])
+        y_chunk = y[start:end]
+        # summed without leaving the device, read once at the end
+        n_correct = n_correct + (scores.argmax(-1) == y_chunk).sum(-1)
+        if loss_fn is not None:
+            loss_sum = loss_sum + loss_fn(scores, y_chunk) * y_chunk.shape[0]
+
+    def mean(total):
+        total = total.tolist() if hasattr(total, "tolist") else total
+        if isinstance(total, list):
+            return [t / n_examples for t in total]
+        return total / n_examples
+
+    return mean(n_correct), mean(loss_sum) if loss_fn is not None else None